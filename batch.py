@@ -0,0 +1,136 @@
+"""Render many compositions to MIDI files on a process pool.
+
+A job is either a composition script (a path; it is run as __main__ and its
+play_recordings call is redirected to the output file) or a list of
+recordings. Results come back as a manifest in job order.
+
+Usage:
+    python batch.py OUT_DIR SCRIPT [SCRIPT ...] [-j WORKERS] [--max-in-flight N] [--tempo BPM]
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+import json
+import os
+import runpy
+import sys
+import time
+import traceback
+
+MANIFEST_NAME = 'manifest.json'
+
+def _init_worker():
+    """Warm a worker once: import the wrapper and build the lookup tables every job uses"""
+    import wrapper  # noqa: F401 - imported for its side effect of loading everything
+    import pitches
+    pitches.midi_pitch('A4')
+
+def _run_script(path, output):
+    """Run a composition script as __main__ with play_recordings redirected to output"""
+    import wrapper
+
+    if os.path.exists(output):
+        os.remove(output)  # so a stale file from an earlier run is not mistaken for output
+    script_dir = os.path.dirname(os.path.abspath(path))
+    added = script_dir not in sys.path
+    if added:
+        sys.path.insert(0, script_dir)
+    try:
+        with wrapper.Recorder(), wrapper.render_playback_to(output):
+            try:
+                runpy.run_path(path, run_name='__main__')
+            except SystemExit as exit:
+                if exit.code not in (None, 0):
+                    raise  # sys.exit(0) at the end of a script is a normal finish
+    finally:
+        if added:
+            sys.path.remove(script_dir)
+    if not os.path.exists(output):
+        raise RuntimeError(f"{path} did not call play_recordings")
+
+def _render_job(source, output, tempo_bpm):
+    """Worker entry point: render one job, never raise (errors go in the result)"""
+    import smf
+
+    start = time.perf_counter()
+    result = {'output': output, 'ok': True, 'error': None}
+    try:
+        if isinstance(source, (str, os.PathLike)):
+            _run_script(os.fspath(source), output)
+        else:
+            smf.write_midi(source, output, tempo_bpm)
+        result['bytes'] = os.path.getsize(output)
+    except KeyboardInterrupt:
+        raise
+    except BaseException:   # includes SystemExit from the script (see _run_script)
+        result.update(ok=False, error=traceback.format_exc(), bytes=0)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def _output_name(index, source):
+    if isinstance(source, (str, os.PathLike)):
+        stem = os.path.splitext(os.path.basename(os.fspath(source)))[0]
+        return f"{index:05d}-{stem}.mid"
+    return f"{index:05d}.mid"
+
+def render_batch(jobs, out_dir, workers=None, max_in_flight=None, tempo_bpm=100):
+    """Render jobs (script paths or lists of recordings) to MIDI files in out_dir.
+
+    At most max_in_flight jobs (default 2 per worker) are submitted at a time,
+    so jobs can be a lazy generator of large recordings. A failing job does
+    not stop the batch: its traceback is recorded in the manifest. Returns the
+    manifest (one dict per job, in job order) and also writes it to
+    out_dir/manifest.json.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * workers
+    manifest = []
+    pending = {}
+
+    def collect(done):
+        for future in done:
+            index = pending.pop(future)
+            try:
+                manifest[index].update(future.result())
+            except BrokenProcessPool:
+                manifest[index].update(ok=False, error="worker process died", bytes=0, seconds=0.0)
+            except Exception:   # e.g. the job could not be pickled to send to a worker
+                manifest[index].update(ok=False, error=traceback.format_exc(), bytes=0, seconds=0.0)
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker) as pool:
+        for index, source in enumerate(jobs):
+            if len(pending) >= max_in_flight:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            output = os.path.join(out_dir, _output_name(index, source))
+            manifest.append({'index': index,
+                             'source': os.fspath(source) if isinstance(source, (str, os.PathLike)) else None,
+                             'output': output})
+            pending[pool.submit(_render_job, source, output, tempo_bpm)] = index
+        collect(wait(pending).done)
+
+    with open(os.path.join(out_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render composition scripts to MIDI files in parallel")
+    parser.add_argument('out_dir')
+    parser.add_argument('scripts', nargs='+')
+    parser.add_argument('-j', '--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--max-in-flight', type=int, default=None, help="jobs submitted at once (default: 2 per worker)")
+    parser.add_argument('--tempo', type=float, default=100, help="tempo for recording jobs (scripts set their own)")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    manifest = render_batch(args.scripts, args.out_dir, args.workers, args.max_in_flight, args.tempo)
+    failed = [entry for entry in manifest if not entry['ok']]
+    print(f"Rendered {len(manifest) - len(failed)}/{len(manifest)} in {time.perf_counter() - start:.2f}s "
+          f"(manifest: {os.path.join(args.out_dir, MANIFEST_NAME)})")
+    for entry in failed:
+        print(f"FAILED {entry['source']}:\n{entry['error']}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
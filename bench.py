@@ -0,0 +1,499 @@
+"""Performance checks for the wrapper.
+
+Usage:
+    python bench.py startup       # import time of wrapper; fails if it pulls in music21
+    python bench.py concurrency   # many concurrent recording sessions; fails if any interfere
+    python bench.py streaming     # peak memory of stream_wav vs piece length; fails if it grows
+    python bench.py merge [PARTS [NOTES]] [--midi]   # old per-element Score assembly vs to_score and encode_midi
+    python bench.py import [MEGABYTES] [--music21]   # read_midi throughput on a generated multi-MB file
+    python bench.py stems         # load more .rec stems than the open-file limit and export them; fails on error
+    python bench.py suite [--out results.json] [--quick]   # per-stage timings on synthetic workloads
+    python bench.py compare BASELINE.json RESULTS.json [--tolerance 0.2]   # flag regressions
+"""
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import platform
+import subprocess
+import sys
+import time
+
+# Run in a fresh interpreter so nothing is already imported
+_STARTUP_SNIPPET = """
+import json, sys, time
+t = time.perf_counter()
+import wrapper
+elapsed = time.perf_counter() - t
+print(json.dumps({
+    'import_seconds': elapsed,
+    'music21_loaded': any(m == 'music21' or m.startswith('music21.') for m in sys.modules),
+}))
+"""
+
+def measure_startup(runs=5):
+    """Import `wrapper` in fresh interpreters; return the best import time and whether music21 was loaded"""
+    results = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', _STARTUP_SNIPPET],
+                             capture_output=True, text=True, check=True)
+        results.append(json.loads(out.stdout))
+    return {
+        'import_seconds': min(r['import_seconds'] for r in results),
+        'music21_loaded': any(r['music21_loaded'] for r in results),
+    }
+
+def check_startup():
+    """Print the startup measurement; exit non-zero if importing wrapper loaded music21"""
+    result = measure_startup()
+    print(f"import wrapper: {result['import_seconds'] * 1000:.1f} ms")
+    if result['music21_loaded']:
+        print("FAIL: importing wrapper imported music21")
+        return 1
+    return 0
+
+def _expected_pitches(job, notes):
+    return [40 + (job + i) % 48 for i in range(notes)]
+
+def _record_job(job, notes=200):
+    """Record a job-specific melody through the module-level functions"""
+    import wrapper
+
+    wrapper.start_recording()
+    for p in _expected_pitches(job, notes):
+        wrapper.play_piano(p, 0.5)
+        wrapper.wait(0.5)
+    return wrapper.end_recording()
+
+async def _record_task(job, notes=200):
+    """Like _record_job but yields to the event loop between notes"""
+    import wrapper
+
+    with wrapper.Recorder():
+        for p in _expected_pitches(job, notes):
+            wrapper.play_piano(p, 0.5)
+            await asyncio.sleep(0)
+            wrapper.wait(0.5)
+        return wrapper.end_recording()
+
+def _check_job(job, recording, notes=200):
+    """True if the recording holds exactly this job's notes at the right offsets"""
+    got = [(onset, pitch) for onset, _, pitch, _, _ in recording.notes()]
+    return got == [(i * 0.5, p) for i, p in enumerate(_expected_pitches(job, notes))]
+
+def check_concurrency(jobs=500, threads=32):
+    """Record many sessions at once on a thread pool and on one event loop; exit non-zero on any mix-up"""
+    t = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        results = list(pool.map(_record_job, range(jobs)))
+    bad = [job for job, rec in enumerate(results) if not _check_job(job, rec)]
+    print(f"threads: {jobs} sessions on {threads} threads in {time.perf_counter() - t:.2f}s, {len(bad)} corrupted")
+
+    async def run_tasks():
+        return await asyncio.gather(*(_record_task(job) for job in range(jobs)))
+
+    t = time.perf_counter()
+    results = asyncio.run(run_tasks())
+    bad_tasks = [job for job, rec in enumerate(results) if not _check_job(job, rec)]
+    print(f"asyncio: {jobs} concurrent tasks in {time.perf_counter() - t:.2f}s, {len(bad_tasks)} corrupted")
+    if bad or bad_tasks:
+        print("FAIL: concurrent sessions interfered")
+        return 1
+    return 0
+
+class _NullPipe(io.RawIOBase):
+    """A write-only, non-seekable sink like a pipe"""
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return len(data)
+
+def _groove(bars):
+    """A drums + bass + pad piece of the given number of 4/4 bars"""
+    import wrapper
+
+    parts = []
+    wrapper.play_sequence('drum', ['kick', 'hihat', 'snare', 'hihat'] * bars, 1)
+    parts.append(wrapper.end_recording())
+    wrapper.play_sequence('bass_synth', ['C2', 'G2', 'A#2', 'F2'] * bars, 1)
+    parts.append(wrapper.end_recording())
+    wrapper.play_sequence('pad_synth', ['C4', 'D#4'] * (bars * 2), 2)
+    parts.append(wrapper.end_recording())
+    return parts
+
+def check_streaming(lengths=(16, 64, 256), tolerance=1.5):
+    """Stream pieces of growing length to a pipe; exit non-zero if peak memory grows with length"""
+    import tracemalloc
+    import synth
+
+    peaks = []
+    for bars in lengths:
+        parts = _groove(bars)       # the recordings themselves are allowed to grow
+        tracemalloc.start()
+        t = time.perf_counter()
+        frames = synth.stream_wav(parts, _NullPipe(), tempo_bpm=120)
+        elapsed = time.perf_counter() - t
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        peaks.append(peak)
+        print(f"{bars:4d} bars: {frames / synth.SAMPLE_RATE:7.1f}s audio in {elapsed:.2f}s, "
+              f"peak {peak / 1024:.0f} KiB")
+    if peaks[-1] > peaks[0] * tolerance:
+        print("FAIL: streaming memory grows with piece length")
+        return 1
+    return 0
+
+def _random_parts(parts, notes, seed=0):
+    """parts recordings of notes random notes each, cycling through the registry instruments"""
+    import random
+    import wrapper
+
+    rng = random.Random(seed)
+    names = sorted(wrapper.INSTRUMENTS)
+    recordings = []
+    for i in range(parts):
+        wrapper.play_sequence(names[i % len(names)],
+                              [rng.randint(36, 84) for _ in range(notes)],
+                              [rng.choice((0.25, 0.5, 1.0)) for _ in range(notes)])
+        recordings.append(wrapper.end_recording())
+    return recordings
+
+def _legacy_score(streams, tempo_bpm=100):
+    """The score assembly play_recordings used to do: copy every element with part.insert"""
+    from music21 import stream, tempo, meter, instrument, note
+
+    score = stream.Score()
+    score.insert(0, tempo.MetronomeMark(number=tempo_bpm))
+    score.insert(0, meter.TimeSignature('4/4'))
+    for s in streams:
+        part = stream.Part()
+        insts = s.getElementsByClass(instrument.Instrument)
+        is_percussion = False
+        if insts:
+            is_percussion = isinstance(insts[0], instrument.Percussion)
+            part.insert(0, insts[0])
+        if is_percussion:
+            part.midiChannel = 9
+            part.midiProgram = 0
+        for element in s:
+            if not isinstance(element, instrument.Instrument):
+                if is_percussion and isinstance(element, note.Note):
+                    element.midiChannel = 9
+                part.insert(element.offset, element)
+        score.insert(0, part)
+    return score
+
+def bench_merge(parts=64, notes=10_000, midi=False):
+    """Time what replaced the old per-element Score assembly: to_score (coreInsert) and encode_midi.
+
+    With midi=True the old export is timed end to end (assembly plus
+    music21's MIDI translation), which is what encode_midi replaced.
+    """
+    import recording
+    import smf
+
+    recordings = _random_parts(parts, notes)
+    total = parts * notes
+    print(f"{parts} parts x {notes} notes = {total} notes")
+
+    def timed_run(label, fn, *args):
+        t = time.perf_counter()
+        result = fn(*args)
+        seconds = time.perf_counter() - t
+        print(f"  {label:<38}{seconds:8.2f}s  ({total / seconds:12,.0f} notes/s)")
+        return seconds, result
+
+    streams = [rec.to_stream() for rec in recordings]   # what end_recording used to return
+    legacy, legacy_score = timed_run("old: per-element Score insertion", _legacy_score, streams)
+    del streams
+    legacy_export = None
+    if midi:
+        from music21 import midi as m21midi
+
+        translate, _ = timed_run("old: music21 MIDI translation",
+                                 lambda score: m21midi.translate.music21ObjectToMidiFile(score).writestr(),
+                                 legacy_score)
+        legacy_export = legacy + translate
+    del legacy_score
+
+    score, _ = timed_run("new: to_score (coreInsert, one sort)", lambda: recording.to_score(recordings))
+    encoded, _ = timed_run("new: encode_midi (no music21)", lambda: smf.encode_midi(recordings))
+
+    print(f"  to_score vs old Score assembly: {legacy / score:.1f}x")
+    if legacy_export is None:
+        print(f"  encode_midi vs old Score assembly alone: {legacy / encoded:.1f}x "
+              f"(a lower bound; --midi times the old export end to end)")
+    else:
+        print(f"  encode_midi vs old export (assembly + MIDI translation): {legacy_export / encoded:.1f}x")
+    return 0
+
+def _edge_notes():
+    """Notes encode_midi has to order carefully: zero-length ones (alone, at the end, beside the same pitch)"""
+    from recording import Recording
+
+    rec = Recording()
+    for pitch, onset, duration in ((60, 0, 0), (60, 1, 0), (60, 1, 1), (62, 2, 1), (62, 3, 0), (64, 5, 0)):
+        rec.append(pitch, onset, duration)
+    rec.length = 6.0
+    return rec
+
+def bench_import(megabytes=8.0, music21=False):
+    """Throughput of smf.read_midi on a generated file of about `megabytes` MB (optionally vs music21's parser)"""
+    import smf
+
+    edge = _edge_notes()
+    read = smf.read_midi(io.BytesIO(smf.encode_midi([edge])))
+    if len(read) != 1 or list(read[0].events()) != list(edge.events()):
+        print("FAIL: zero-length notes do not survive a MIDI round trip")
+        return 1
+
+    notes = 20_000
+    parts = max(1, round(megabytes * 1_000_000 / (notes * 7)))  # about 7 bytes per note with running status
+    data = smf.encode_midi(_random_parts(parts, notes))
+    size = len(data) / 1_000_000
+    total = parts * notes
+    print(f"{size:.1f} MB, {parts} tracks x {notes} notes = {total} notes")
+
+    t = time.perf_counter()
+    recordings = smf.read_midi(io.BytesIO(data))
+    seconds = time.perf_counter() - t
+    read = sum(len(rec) for rec in recordings)
+    if read != total:
+        print(f"FAIL: read {read} notes, expected {total}")
+        return 1
+    print(f"  read_midi:        {seconds:8.2f}s  ({size / seconds:6.1f} MB/s, {total / seconds:12,.0f} notes/s)")
+
+    if music21:
+        from music21 import converter
+
+        sample = smf.encode_midi(recordings[:1])    # one track: music21 is far too slow for the whole file
+        t = time.perf_counter()
+        converter.parseData(sample, format='midi')
+        m21 = time.perf_counter() - t
+        print(f"  music21 (1 track):{m21:8.2f}s  ({len(sample) / 1_000_000 / m21:6.3f} MB/s, {notes / m21:12,.0f} notes/s)")
+        print(f"  read_midi speedup: {(total / seconds) / (notes / m21):.0f}x")
+    return 0
+
+def check_stems(extra=500):
+    """Save more stems than RLIMIT_NOFILE allows open files, load them all, pickle one and export the lot"""
+    import os
+    import pickle
+    import resource
+    import tempfile
+    import smf
+    import store
+
+    limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if limit == resource.RLIM_INFINITY or limit > 4096:
+        limit = 1024
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, resource.getrlimit(resource.RLIMIT_NOFILE)[1]))
+    count = limit + extra
+    with tempfile.TemporaryDirectory() as tmp:
+        stem = _groove(1)[0]
+        large = _random_parts(1, store.MMAP_MIN_BYTES // 18 + 1)[0]    # big enough to be memory-mapped
+        paths = []
+        for i in range(count):
+            paths.append(os.path.join(tmp, f"{i}.rec"))
+            store.save_recording(large if i == 0 else stem, paths[-1])
+        t = time.perf_counter()
+        stems = store.load_recordings(paths)
+        data = smf.encode_midi(stems)
+        seconds = time.perf_counter() - t
+        expected = smf.encode_midi([large] + [stem] * (count - 1))
+        if data != expected:
+            print(f"FAIL: {count} loaded stems do not export like the originals")
+            return 1
+        copy = pickle.loads(pickle.dumps(stems[0]))
+        if list(copy.events()) != list(large.events()):
+            print("FAIL: a pickled stem does not round-trip")
+            return 1
+        del stems, copy
+    print(f"OK: loaded and exported {count} stems (open-file limit {limit}) in {seconds:.2f}s; pickling works")
+    return 0
+
+SUITE_SIZES = (1_000, 10_000, 100_000, 1_000_000)
+SUITE_INSTRUMENTS = (1, 8, 64)
+QUICK_SIZES = (1_000, 10_000)
+QUICK_INSTRUMENTS = (1, 8)
+MUSIC21_SCORE_LIMIT = 10_000  # building a music21 Score is too slow to time beyond this
+
+# Metrics compared by `compare`: seconds and bytes, where bigger is worse
+_COMPARED = ('record_s', 'end_recording_s', 'play_recordings_s', 'music21_score_s',
+             'midi_encode_s', 'peak_bytes_per_note')
+
+def _workload(notes, instruments, seed=0):
+    """Per instrument: its play_* function, note numbers and durations (notes split evenly)"""
+    import random
+    import wrapper
+
+    rng = random.Random(seed)
+    names = [name for name in sorted(wrapper.INSTRUMENTS) if name != 'drum']
+    per_part = notes // instruments
+    return [(getattr(wrapper, 'play_' + names[i % len(names)]),
+             [rng.randint(36, 84) for _ in range(per_part)],
+             [rng.choice((0.25, 0.5, 1.0)) for _ in range(per_part)])
+            for i in range(instruments)]
+
+def _record(workload):
+    """Record every part with one play_* call and one wait per note; returns (recordings, seconds in end_recording)"""
+    import wrapper
+
+    recordings = []
+    ended = 0.0
+    for play, pitches, durations in workload:
+        wrapper.start_recording()
+        for p, d in zip(pitches, durations):
+            play(p, d)
+            wrapper.wait(d)
+        t = time.perf_counter()
+        recordings.append(wrapper.end_recording())
+        ended += time.perf_counter() - t
+    return recordings, ended
+
+def _best(fn, repeat):
+    """Best wall time of fn over repeat runs, plus the last result"""
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def bench_workload(notes, instruments, repeat=3):
+    """Time each pipeline stage for one synthetic workload"""
+    import tracemalloc
+    import recording
+    import smf
+    import wrapper
+
+    workload = _workload(notes, instruments)
+    notes = sum(len(pitches) for _, pitches, _ in workload)
+    repeat = repeat if notes <= 100_000 else 1
+    row = {'notes': notes, 'instruments': instruments}
+
+    record_s, (recordings, _) = _best(lambda: _record(workload), repeat)
+    row['record_s'] = record_s
+    row['record_notes_per_s'] = notes / record_s
+    row['end_recording_s'] = min(_record(workload)[1] for _ in range(repeat))
+
+    row['play_recordings_s'], _ = _best(
+        lambda: _play_headless(wrapper, recordings), repeat)
+    row['midi_encode_s'], data = _best(lambda: smf.encode_midi(recordings), repeat)
+    row['midi_bytes'] = len(data)
+    if notes <= MUSIC21_SCORE_LIMIT:
+        row['music21_score_s'], _ = _best(lambda: recording.to_score(recordings), 1)
+    else:
+        row['music21_score_s'] = None
+
+    del recordings
+    tracemalloc.start()
+    recordings, _ = _record(workload)
+    row['peak_bytes_per_note'] = tracemalloc.get_traced_memory()[1] / notes
+    tracemalloc.stop()
+    return row
+
+def _play_headless(wrapper, recordings):
+    """What play_recordings costs without the MIDI player"""
+    buffer = io.BytesIO()
+    with wrapper.render_playback_to(buffer):
+        wrapper.play_recordings(recordings)
+    return buffer
+
+def run_suite(sizes=SUITE_SIZES, instruments=SUITE_INSTRUMENTS, repeat=3):
+    """Run every (notes, instruments) workload; returns the JSON-ready results"""
+    if min(sizes) <= MUSIC21_SCORE_LIMIT:
+        import music21.stream  # noqa: F401 - so the first score build doesn't pay for the import
+    results = []
+    for notes in sizes:
+        for count in instruments:
+            if count > notes:
+                continue
+            row = bench_workload(notes, count, repeat)
+            results.append(row)
+            score = row['music21_score_s']
+            print(f"{row['notes']:>9,} notes x {count:>2} instruments: "
+                  f"record {row['record_notes_per_s']:>10,.0f} notes/s, "
+                  f"end {row['end_recording_s'] * 1000:8.2f} ms, "
+                  f"play_recordings {row['play_recordings_s'] * 1000:9.1f} ms, "
+                  f"midi {row['midi_encode_s'] * 1000:9.1f} ms, "
+                  f"score {'-' if score is None else f'{score * 1000:.0f} ms':>9}, "
+                  f"{row['peak_bytes_per_note']:6.1f} B/note")
+    return {
+        'meta': {'python': platform.python_version(), 'platform': platform.platform(),
+                 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'results': results,
+    }
+
+def compare_results(baseline, current, tolerance=0.2):
+    """Regressions of current vs baseline: [(workload, metric, baseline value, current value)]"""
+    def key(row):
+        return row['notes'], row['instruments']
+
+    base = {key(row): row for row in baseline['results']}
+    regressions = []
+    for row in current['results']:
+        old = base.get(key(row))
+        if old is None:
+            continue
+        for metric in _COMPARED:
+            before, after = old.get(metric), row.get(metric)
+            if before and after is not None and after > before * (1 + tolerance):
+                regressions.append((f"{row['notes']}x{row['instruments']}", metric, before, after))
+    return regressions
+
+def _suite_command(args):
+    sizes = QUICK_SIZES if args.quick else SUITE_SIZES
+    instruments = QUICK_INSTRUMENTS if args.quick else SUITE_INSTRUMENTS
+    results = run_suite(sizes, instruments, args.repeat)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.out}")
+    return 0
+
+def _compare_command(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.results) as f:
+        current = json.load(f)
+    regressions = compare_results(baseline, current, args.tolerance)
+    for workload, metric, before, after in regressions:
+        print(f"REGRESSION {workload} {metric}: {before:.6g} -> {after:.6g} ({after / before - 1:+.0%})")
+    if regressions:
+        return 1
+    print(f"No regressions beyond {args.tolerance:.0%}")
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Performance checks for the wrapper")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('startup').set_defaults(run=lambda args: check_startup())
+    commands.add_parser('concurrency').set_defaults(run=lambda args: check_concurrency())
+    commands.add_parser('streaming').set_defaults(run=lambda args: check_streaming())
+    merge = commands.add_parser('merge')
+    merge.add_argument('parts', type=int, nargs='?', default=64)
+    merge.add_argument('notes', type=int, nargs='?', default=10_000)
+    merge.add_argument('--midi', action='store_true', help="also time the old music21 MIDI translation")
+    merge.set_defaults(run=lambda args: bench_merge(args.parts, args.notes, args.midi))
+    commands.add_parser('stems').set_defaults(run=lambda args: check_stems())
+    imports = commands.add_parser('import')
+    imports.add_argument('megabytes', type=float, nargs='?', default=8.0)
+    imports.add_argument('--music21', action='store_true', help="also time music21's converter on one track")
+    imports.set_defaults(run=lambda args: bench_import(args.megabytes, args.music21))
+    suite = commands.add_parser('suite')
+    suite.add_argument('--out', default='bench-results.json')
+    suite.add_argument('--quick', action='store_true', help="only the small workloads")
+    suite.add_argument('--repeat', type=int, default=3, help="best of N runs (workloads up to 100k notes)")
+    suite.set_defaults(run=_suite_command)
+    compare = commands.add_parser('compare')
+    compare.add_argument('baseline')
+    compare.add_argument('results')
+    compare.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown, 0.2 = 20%%")
+    compare.set_defaults(run=_compare_command)
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
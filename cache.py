@@ -0,0 +1,226 @@
+"""Content-addressed cache for rendered MIDI and WAV bytes.
+
+The key is a hash of every recording's events and instrument plus the tempo
+and output format, so re-rendering an unchanged piece (batch reruns, a
+notebook cell run twice, CI) returns the stored bytes without encoding,
+synthesizing, or importing music21. Entries live in an in-memory LRU and,
+if a directory is given, in an on-disk tier shared between processes.
+
+    cache = RenderCache(directory='.render-cache')
+    data = cache.midi([melody, bass], tempo_bpm=120)
+    cache.write_midi([melody, bass], 'song.mid')
+    print(cache.stats())
+"""
+from collections import OrderedDict
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+
+import profiling
+from recording import as_recording
+
+KEY_VERSION = 1     # bump when an encoder's output changes, so old entries stop matching
+DEFAULT_MEMORY_BYTES = 64 * 1024 * 1024
+DEFAULT_DISK_BYTES = 1024 * 1024 * 1024
+_SUFFIX = '.bin'
+
+def render_key(recordings, fmt, **params):
+    """Stable hex key for rendering recordings as fmt ('midi', 'wav', ...) with the given parameters"""
+    h = hashlib.sha256(f"{KEY_VERSION}:{fmt}:{sorted(params.items())!r}".encode())
+    for rec in recordings:
+        h.update(as_recording(rec).digest().encode())
+    return h.hexdigest()
+
+
+class RenderCache:
+    """Two-tier (memory LRU, optional directory) cache of rendered output, keyed by content"""
+
+    def __init__(self, max_memory_bytes=DEFAULT_MEMORY_BYTES, directory=None, max_disk_bytes=DEFAULT_DISK_BYTES):
+        self.max_memory_bytes = max_memory_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()    # key -> bytes, least recently used first
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.disk_hits = self.evictions = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        """Cached bytes for key, or None"""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return data
+        data = self._disk_get(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+        self._memory_put(key, data)
+        return data
+
+    def put(self, key, data):
+        data = bytes(data)
+        self._memory_put(key, data)
+        if self.directory:
+            self._disk_put(key, data)
+
+    def get_or_render(self, recordings, fmt, render, **params):
+        """Cached output for (recordings, fmt, params), calling render() to produce it on a miss"""
+        recordings = list(recordings)
+        key = render_key(recordings, fmt, **params)
+        data = self.get(key)
+        stats = profiling.active.get()
+        if stats:
+            stats.count('cache_misses' if data is None else 'cache_hits')
+        if data is None:
+            data = render()
+            self.put(key, data)
+        return data
+
+    def midi(self, recordings, tempo_bpm=100):
+        """Standard MIDI File bytes for recordings, from the cache when possible"""
+        recordings = list(recordings)
+
+        def render():
+            import smf
+            return smf.encode_midi(recordings, tempo_bpm)
+        return self.get_or_render(recordings, 'midi', render, tempo_bpm=tempo_bpm)
+
+    def wav(self, recordings, tempo_bpm=100, sample_rate=None):
+        """Synthesized WAV file bytes for recordings (needs NumPy on a miss), from the cache when possible"""
+        import synth
+        recordings = list(recordings)
+        sample_rate = sample_rate or synth.SAMPLE_RATE
+
+        def render():
+            buffer = io.BytesIO()
+            synth.write_wav(recordings, buffer, tempo_bpm, sample_rate)
+            return buffer.getvalue()
+        return self.get_or_render(recordings, 'wav', render, tempo_bpm=tempo_bpm, sample_rate=sample_rate)
+
+    def write_midi(self, recordings, path, tempo_bpm=100):
+        """Like smf.write_midi but through the cache; returns the number of bytes written"""
+        return _write_file(path, self.midi(recordings, tempo_bpm))
+
+    def write_wav(self, recordings, path, tempo_bpm=100, sample_rate=None):
+        """Like synth.write_wav but through the cache; returns the number of bytes written"""
+        return _write_file(path, self.wav(recordings, tempo_bpm, sample_rate))
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        if disk and self.directory:
+            for name, _, _ in self._disk_entries():
+                _remove(os.path.join(self.directory, name))
+
+    def stats(self):
+        """Hit/miss counts and tier sizes as a plain dict"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            report = {'hits': self.hits, 'misses': self.misses, 'disk_hits': self.disk_hits,
+                      'hit_rate': self.hits / lookups if lookups else 0.0,
+                      'evictions': self.evictions,
+                      'memory_entries': len(self._memory), 'memory_bytes': self._memory_bytes}
+        if self.directory:
+            entries = self._disk_entries()
+            report.update(disk_entries=len(entries), disk_bytes=sum(size for _, size, _ in entries))
+        return report
+
+    def _memory_put(self, key, data):
+        if len(data) > self.max_memory_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= len(old)
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+                self.evictions += 1
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def _disk_get(self, key):
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)  # mtime doubles as last use, for eviction
+        except OSError:
+            pass
+        return data
+
+    def _disk_put(self, key, data):
+        if len(data) > self.max_disk_bytes:
+            return
+        # Write then rename, so other processes sharing the directory never read a partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            _remove(tmp)
+            raise
+        self._evict_disk()
+
+    def _disk_entries(self):
+        """(name, size, mtime) for every entry in the directory"""
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(_SUFFIX):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue  # evicted by another process
+                    entries.append((entry.name, st.st_size, st.st_mtime))
+        return entries
+
+    def _evict_disk(self):
+        entries = self._disk_entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_disk_bytes:
+            return
+        entries.sort(key=lambda entry: entry[2])
+        for name, size, _ in entries:
+            if total <= self.max_disk_bytes:
+                break
+            _remove(os.path.join(self.directory, name))
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+
+def _write_file(path, data):
+    start = time.perf_counter()
+    with open(path, 'wb') as f:
+        f.write(data)
+    stats = profiling.active.get()
+    if stats:
+        stats.record('cache_write', start, bytes_written=len(data))
+    return len(data)
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,138 @@
+"""Instrument registry shared by the recording API and the export engines"""
+from collections import namedtuple
+
+# Stable identity of an instrument: GM program (0-indexed, None for drums),
+# display name and whether it plays on the percussion channel
+InstrumentId = namedtuple('InstrumentId', ['program', 'name', 'percussion'])
+
+# Instrument registry - one row per play_* function:
+# (function suffix, music21 class or None for a generic GM instrument, GM program, name, docstring)
+_INSTRUMENT_TABLE = [
+    ('piano', 'Piano', 0, 'Piano', "Play a piano note (e.g., 'A4', 'C#5', 'G#6')"),
+    ('guitar', 'AcousticGuitar', 24, 'Acoustic Guitar', "Play a guitar note (e.g., 'A4', 'C#5', 'G#6')"),
+    ('flute', 'Flute', 73, 'Flute', "Play a flute note (e.g., 'A4', 'C#5', 'G#6')"),
+
+    # Real Electronic/Synth Instruments (using proper MIDI program numbers)
+    ('synth', None, 80, 'Synth Lead 1', "Play a synthesizer note - Lead 1 (Sawtooth)"),
+    ('lead_synth', None, 81, 'Synth Lead 2', "Play a lead synthesizer - Lead 2 (Sawtooth)"),
+    ('lead_synth_square', None, 82, 'Synth Lead 3', "Play a square wave lead synth - Lead 3 (Calliope)"),
+    ('lead_synth_chiff', None, 83, 'Synth Lead 4', "Play a chiff lead synth - Lead 4 (Chiff)"),
+    ('lead_synth_charang', None, 84, 'Synth Lead 5', "Play a charang lead synth - Lead 5 (Charang)"),
+    ('lead_synth_voice', None, 85, 'Synth Lead 6', "Play a voice lead synth - Lead 6 (Voice)"),
+    ('lead_synth_fifths', None, 86, 'Synth Lead 7', "Play a fifths lead synth - Lead 7 (Fifths)"),
+    ('lead_synth_bass_lead', None, 87, 'Synth Lead 8', "Play a bass lead synth - Lead 8 (Bass + Lead)"),
+    ('pad_synth', None, 88, 'Synth Pad 1', "Play a pad synthesizer - Pad 1 (New Age)"),
+    ('pad_synth_warm', None, 89, 'Synth Pad 2', "Play a warm pad synth - Pad 2 (Warm)"),
+    ('pad_synth_polysynth', None, 90, 'Synth Pad 3', "Play a polysynth pad - Pad 3 (Polysynth)"),
+    ('pad_synth_choir', None, 91, 'Synth Pad 4', "Play a choir pad synth - Pad 4 (Choir)"),
+    ('pad_synth_bowed', None, 92, 'Synth Pad 5', "Play a bowed pad synth - Pad 5 (Bowed)"),
+    ('pad_synth_metallic', None, 93, 'Synth Pad 6', "Play a metallic pad synth - Pad 6 (Metallic)"),
+    ('pad_synth_halo', None, 94, 'Synth Pad 7', "Play a halo pad synth - Pad 7 (Halo)"),
+    ('pad_synth_sweep', None, 95, 'Synth Pad 8', "Play a sweep pad synth - Pad 8 (Sweep)"),
+    ('bass_synth', None, 38, 'Synth Bass 1', "Play a bass synthesizer - Synth Bass 1"),
+    ('bass_synth_2', None, 39, 'Synth Bass 2', "Play a bass synthesizer - Synth Bass 2"),
+    ('synth_brass', None, 62, 'Synth Brass 1', "Play a synth brass - Synth Brass 1"),
+    ('synth_brass_2', None, 63, 'Synth Brass 2', "Play a synth brass - Synth Brass 2"),
+    ('synth_strings', None, 50, 'Synth Strings 1', "Play synth strings - Synth Strings 1"),
+    ('synth_strings_2', None, 51, 'Synth Strings 2', "Play synth strings - Synth Strings 2"),
+
+    # Electronic/Synth Instruments (keeping electric piano)
+    ('electric_piano', 'ElectricPiano', 2, 'Electric Piano', "Play an electric piano note"),
+    ('bass', 'AcousticBass', 32, 'Acoustic Bass', "Play an acoustic bass note"),
+    ('electric_bass', 'ElectricBass', 33, 'Electric Bass', "Play an electric bass note"),
+    ('fretless_bass', 'FretlessBass', 35, 'Fretless Bass', "Play a fretless bass note"),
+
+    # Brass Instruments
+    ('trumpet', 'Trumpet', 56, 'Trumpet', "Play a trumpet note"),
+    ('trombone', 'Trombone', 57, 'Trombone', "Play a trombone note"),
+    ('horn', 'Horn', 60, 'Horn', "Play a French horn note"),
+
+    # Woodwind Instruments
+    ('saxophone', 'AltoSaxophone', 65, 'Alto Saxophone', "Play a saxophone note (alto sax)"),
+    ('clarinet', 'Clarinet', 71, 'Clarinet', "Play a clarinet note"),
+    ('oboe', 'Oboe', 68, 'Oboe', "Play an oboe note"),
+
+    # String Instruments (music21 calls the cello Violoncello)
+    ('violin', 'Violin', 40, 'Violin', "Play a violin note"),
+    ('viola', 'Viola', 41, 'Viola', "Play a viola note"),
+    ('cello', 'Violoncello', 42, 'Violoncello', "Play a cello note"),
+    ('harp', 'Harp', 46, 'Harp', "Play a harp note"),
+
+    # Other Instruments
+    ('organ', 'Organ', 19, 'Organ', "Play an organ note"),
+    ('harpsichord', 'Harpsichord', 6, 'Harpsichord', "Play a harpsichord note"),
+    ('celesta', 'Celesta', 8, 'Celesta', "Play a celesta note (bell-like sound)"),
+    ('glockenspiel', 'Glockenspiel', 9, 'Glockenspiel', "Play a glockenspiel note"),
+    ('banjo', 'Banjo', 105, 'Banjo', "Play a banjo note"),
+    ('harmonica', 'Harmonica', 22, 'Harmonica', "Play a harmonica note"),
+    ('accordion', 'Accordion', 21, 'Accordion', "Play an accordion note"),
+]
+
+PERCUSSION = InstrumentId(None, 'Percussion', True)
+
+# Registry lookups: play_* suffix -> InstrumentId, and InstrumentId -> music21 class name.
+# The music21 instrument objects are only built (and music21 only imported)
+# the first time something asks for them, see music21_instrument().
+INSTRUMENTS = {'drum': PERCUSSION}
+_instrument_classes = {PERCUSSION: 'Percussion'}
+_instrument_objects = {}
+
+for _suffix, _class_name, _program, _name, _ in _INSTRUMENT_TABLE:
+    INSTRUMENTS[_suffix] = InstrumentId(_program, _name, False)
+    _instrument_classes[INSTRUMENTS[_suffix]] = _class_name
+del _suffix, _class_name, _program, _name
+
+def instrument_for_program(program):
+    """InstrumentId for a GM program number: the registry entry that uses it, or a generic one"""
+    inst_id = _program_instruments.get(program)
+    if inst_id is None:
+        inst_id = _program_instruments[program] = InstrumentId(program, f"Program {program}", False)
+    return inst_id
+
+_program_instruments = {}
+for _inst_id in reversed(list(INSTRUMENTS.values())):   # first play_* name wins
+    if _inst_id.program is not None:
+        _program_instruments[_inst_id.program] = _inst_id
+del _inst_id
+
+def _create_synth_instrument(name, midi_program):
+    """Create a custom synth instrument with specific MIDI program"""
+    from music21 import instrument
+
+    inst = instrument.Instrument()
+    inst.midiProgram = midi_program
+    inst.instrumentName = name
+    return inst
+
+def music21_instrument(inst_id):
+    """The shared music21 instrument for an InstrumentId (built and cached on first use).
+
+    Treat it as read-only; streams get their own copy (see Recording._fill).
+    """
+    inst = _instrument_objects.get(inst_id)
+    if inst is None:
+        from music21 import instrument
+
+        class_name = _instrument_classes.get(inst_id)
+        if class_name is not None:
+            inst = getattr(instrument, class_name)()
+        elif inst_id.percussion:
+            inst = instrument.Percussion()
+        else:
+            inst = _create_synth_instrument(inst_id.name, inst_id.program)
+        _instrument_objects[inst_id] = inst
+    return inst
+
+def instrument_id(instrument_type):
+    """Stable InstrumentId for a music21 instrument (or an InstrumentId passed through)"""
+    if isinstance(instrument_type, InstrumentId):
+        return instrument_type
+    from music21 import instrument
+
+    return InstrumentId(
+        instrument_type.midiProgram,
+        getattr(instrument_type, 'instrumentName', '') or '',
+        # Glockenspiel, Timpani etc. subclass Percussion too, but only unpitched drums belong on channel 10
+        (isinstance(instrument_type, instrument.UnpitchedPercussion)
+         or type(instrument_type) is instrument.Percussion),
+    )
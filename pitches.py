@@ -0,0 +1,71 @@
+"""Note name -> MIDI pitch resolution for the play_* functions"""
+from functools import lru_cache
+import operator
+
+_STEPS = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+# Sharps, flats (music21 spells them '-') and doubles
+_ACCIDENTALS = {'': 0, '#': 1, '##': 2, 'b': -1, 'bb': -2, '-': -1, '--': -2}
+_SINGLE_ACCIDENTALS = {'#': 1, 'b': -1, '-': -1}
+DEFAULT_OCTAVE = 4
+
+def _build_table():
+    """Every common spelling for octaves -1..9 (plus bare letters, octave 4) and MIDI ints 0-127.
+
+    As in music21, '-' is a flat, so 'C-1' is C-flat 1; write octave -1 naturals as MIDI numbers.
+    """
+    table = {n: n for n in range(128)}
+    for letter, step in _STEPS.items():
+        for accidental, alter in _ACCIDENTALS.items():
+            for octave in range(-1, 10):
+                midi = (octave + 1) * 12 + step + alter
+                if 0 <= midi <= 127:
+                    for name in (letter, letter.lower()):
+                        table[f"{name}{accidental}{octave}"] = midi
+            midi = (DEFAULT_OCTAVE + 1) * 12 + step + alter
+            for name in (letter, letter.lower()):
+                table[name + accidental] = midi
+    return table
+
+_PITCH_TABLE = _build_table()
+
+@lru_cache(maxsize=4096)
+def _parse_pitch(value):
+    """Slow path for anything not in the table: odd spellings, whitespace, out-of-range values"""
+    if isinstance(value, str):
+        name = value.strip()
+        if not name or name[0].upper() not in _STEPS:
+            raise ValueError(f"Invalid note name {value!r}: expected a letter A-G, e.g. 'C#5'")
+        midi = _STEPS[name[0].upper()]
+        i = 1
+        while i < len(name) and name[i] in _SINGLE_ACCIDENTALS:
+            midi += _SINGLE_ACCIDENTALS[name[i]]
+            i += 1
+        octave = name[i:]
+        if octave:
+            try:
+                octave = int(octave)
+            except ValueError:
+                raise ValueError(f"Invalid note name {value!r}: bad octave {octave!r}") from None
+        else:
+            octave = DEFAULT_OCTAVE
+        midi += (octave + 1) * 12
+    else:
+        try:
+            midi = operator.index(value)  # ints, NumPy integers
+        except TypeError:
+            raise TypeError(f"Note must be a name like 'C#5' or a MIDI number, "
+                            f"not {type(value).__name__}") from None
+    if not 0 <= midi <= 127:
+        raise ValueError(f"Note {value!r} is outside the MIDI range 0-127")
+    return midi
+
+def midi_pitch(value):
+    """MIDI number for a note name ('A4', 'C#5', 'Bb3', 'E##2') or a MIDI number (returned as is)"""
+    try:
+        return _PITCH_TABLE[value]
+    except KeyError:
+        pass
+    except TypeError:  # unhashable
+        raise TypeError(f"Note must be a name like 'C#5' or a MIDI number, "
+                        f"not {type(value).__name__}") from None
+    return _parse_pitch(value)
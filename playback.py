@@ -0,0 +1,193 @@
+"""Real-time playback of recordings on an asyncio event loop.
+
+A PlaybackSession walks the merged note-on/note-off timeline of its
+recordings and hands each MIDI message to a sink at its wall-clock time for
+the session's tempo. Sessions are plain tasks, so one loop can drive many
+of them at once.
+
+    session = PlaybackSession([piano, drums], MidiByteSink(port), tempo_bpm=120)
+    session.start()
+    await session.seek(16)      # jump to beat 16
+    await session.wait()
+    print(session.jitter_stats())
+
+Sinks only need send(message, when) and close(): MidiByteSink writes raw
+MIDI bytes to a binary stream (a rawmidi device, pipe or socket), FileSink
+logs timestamped messages to a file, FakePort keeps them in a list for
+tests.
+"""
+import asyncio
+import math
+
+from recording import as_recording, timeline
+from smf import NOTE_OFF, NOTE_ON, PROGRAM_CHANGE, assign_channels
+
+
+class MidiByteSink:
+    """Write raw MIDI messages to a binary stream (file object or asyncio StreamWriter)"""
+
+    def __init__(self, stream, close_stream=False):
+        self.stream = stream
+        self.close_stream = close_stream
+
+    def send(self, message, when):
+        self.stream.write(message)
+        flush = getattr(self.stream, 'flush', None)
+        if flush is not None:
+            flush()
+
+    def close(self):
+        if self.close_stream:
+            self.stream.close()
+
+
+class FileSink:
+    """Log each message to a text file as "<seconds since start>\\t<hex bytes>" lines"""
+
+    def __init__(self, path):
+        self._file = open(path, 'w')
+        self._started = None
+
+    def send(self, message, when):
+        if self._started is None:
+            self._started = when
+        self._file.write(f"{when - self._started:.6f}\t{message.hex(' ')}\n")
+
+    def close(self):
+        self._file.close()
+
+
+class FakePort:
+    """In-process sink that keeps (loop time, message bytes) pairs, for tests"""
+
+    def __init__(self):
+        self.messages = []
+        self.closed = False
+
+    def send(self, message, when):
+        self.messages.append((when, message))
+
+    def close(self):
+        self.closed = True
+
+
+class PlaybackSession:
+    """Play recordings through a sink in real time at tempo_bpm, with start/stop/seek"""
+
+    def __init__(self, recordings, sink, tempo_bpm=100):
+        self.recordings = [as_recording(rec) for rec in recordings]
+        self.sink = sink
+        self.seconds_per_beat = 60.0 / tempo_bpm
+        self.channels = assign_channels(self.recordings)
+        self.position = 0.0         # where the next start() plays from: updated by seek() and on stop
+        self._task = None
+        self._sounding = {}         # (channel, pitch) -> number of notes holding it
+        self._jitter = []           # seconds late (negative: early) per dispatched event
+
+    @property
+    def playing(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self, beat=None):
+        """Begin playing from `beat` (default: the current position) on the running loop; returns the task"""
+        if self.playing:
+            raise RuntimeError("Session is already playing; stop() or seek() it instead")
+        if beat is not None:
+            self.position = float(beat)
+        self._task = asyncio.get_running_loop().create_task(self._run(self.position))
+        return self._task
+
+    async def stop(self):
+        """Stop playing and silence any notes still sounding"""
+        task = self._task
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def seek(self, beat):
+        """Move to `beat`; playback continues from there if it was running"""
+        was_playing = self.playing
+        await self.stop()
+        self.position = float(beat)
+        if was_playing:
+            self.start()
+
+    async def wait(self):
+        """Wait until playback reaches the end (or is stopped)"""
+        if self._task is not None:
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def close(self):
+        self.sink.close()
+
+    def jitter_stats(self):
+        """Dispatch timing error so far: event count, mean / RMS / max lateness in milliseconds"""
+        jitter = self._jitter
+        if not jitter:
+            return {'events': 0, 'mean_ms': 0.0, 'rms_ms': 0.0, 'max_ms': 0.0}
+        return {'events': len(jitter),
+                'mean_ms': 1000 * sum(jitter) / len(jitter),
+                'rms_ms': 1000 * math.sqrt(sum(j * j for j in jitter) / len(jitter)),
+                'max_ms': 1000 * max(jitter)}
+
+    def _program_changes(self, when):
+        for rec, channel in zip(self.recordings, self.channels):
+            inst = rec.instrument
+            if inst is not None and not inst.percussion and inst.program is not None:
+                self.sink.send(bytes((PROGRAM_CHANGE | channel, inst.program)), when)
+
+    def _silence(self, when):
+        for (channel, pitch), held in self._sounding.items():
+            for _ in range(held):
+                self.sink.send(bytes((NOTE_OFF | channel, pitch, 0)), when)
+        self._sounding.clear()
+
+    async def _run(self, from_beat):
+        loop = asyncio.get_running_loop()
+        spb = self.seconds_per_beat
+        origin = loop.time() - from_beat * spb
+        sounding = self._sounding
+        self._program_changes(loop.time())
+        try:
+            for beat, is_on, track, pitch, velocity, _ in timeline(self.recordings):
+                if beat < from_beat:
+                    continue
+                channel = self.channels[track]
+                key = (channel, pitch)
+                if not is_on and not sounding.get(key):
+                    continue  # its note-on was before the seek point
+                target = origin + beat * spb
+                delay = target - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                now = loop.time()
+                if is_on:
+                    sounding[key] = sounding.get(key, 0) + 1
+                    self.sink.send(bytes((NOTE_ON | channel, pitch, velocity)), now)
+                else:
+                    sounding[key] -= 1
+                    if not sounding[key]:
+                        del sounding[key]
+                    self.sink.send(bytes((NOTE_OFF | channel, pitch, 0)), now)
+                self._jitter.append(now - target)
+        finally:
+            now = loop.time()
+            self.position = max(from_beat, (now - origin) / spb)
+            self._silence(now)
+
+
+async def play(recordings, sink, tempo_bpm=100):
+    """Play recordings through sink to the end, close the sink and return the jitter stats"""
+    session = PlaybackSession(recordings, sink, tempo_bpm)
+    try:
+        session.start()
+        await session.wait()
+    finally:
+        session.close()
+    return session.jitter_stats()
@@ -0,0 +1,116 @@
+"""Opt-in per-stage timers and counters for the recording and export pipeline.
+
+Nothing is collected unless a collect_stats() block is active; instrumented
+code checks `profiling.active.get()` and skips all timing when it is None.
+Like recording sessions, the active Stats belongs to the current thread or
+asyncio task, so blocks running in parallel each see only their own work.
+
+    with collect_stats() as stats:
+        ...record and export...
+    print(stats.report())
+
+Counters: notes_added, instrument_switches, streams_discarded, bytes_written,
+bytes_read, cache_hits, cache_misses, tracks_encoded, tracks_reused.
+Timers (seconds and calls): add_note, start_recording, stream_build,
+score_build, midi_encode, midi_write, midi_read, audio_render, cache_write.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import threading
+import time
+
+# The Stats being collected into in this thread/task, None when profiling is off
+active = ContextVar('profiling_stats', default=None)
+_hooks = []
+
+
+class Stats:
+    """Counters and per-stage timers collected while profiling is on"""
+
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}        # stage -> [calls, seconds]
+        self.started = time.perf_counter()
+        self.wall_seconds = None
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, stage, seconds, calls=1):
+        with self._lock:
+            timer = self.timers.setdefault(stage, [0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+
+    def record(self, stage, started, **counts):
+        """Add the time since `started` (a perf_counter value) to stage and bump the given counters"""
+        self.add_time(stage, time.perf_counter() - started)
+        for name, n in counts.items():
+            self.count(name, n)
+
+    def merge(self, other):
+        """Fold another Stats into this one (used when collect_stats blocks nest)"""
+        for name, n in other.counters.items():
+            self.count(name, n)
+        for stage, (calls, seconds) in other.timers.items():
+            self.add_time(stage, seconds, calls)
+
+    def report(self):
+        """Plain dict of everything collected, ready for JSON or a metrics system"""
+        with self._lock:
+            return {
+                'wall_seconds': (self.wall_seconds if self.wall_seconds is not None
+                                 else time.perf_counter() - self.started),
+                'counters': dict(self.counters),
+                'timers': {stage: {'calls': calls, 'seconds': seconds}
+                           for stage, (calls, seconds) in self.timers.items()},
+            }
+
+
+@contextmanager
+def collect_stats(hook=None):
+    """Turn profiling on for the block and yield the Stats being filled.
+
+    On exit the report is passed to `hook` (if given) and to every hook
+    registered with add_metrics_hook. Nested blocks also count towards the
+    enclosing one.
+    """
+    outer = active.get()
+    stats = Stats()
+    token = active.set(stats)
+    try:
+        yield stats
+    finally:
+        active.reset(token)
+        stats.wall_seconds = time.perf_counter() - stats.started
+        if outer is not None:
+            outer.merge(stats)
+        report = stats.report()
+        for fn in ([hook] if hook else []) + _hooks:
+            fn(report)
+
+def add_metrics_hook(fn):
+    """Call fn(report) at the end of every collect_stats block, e.g. to push to a metrics system"""
+    _hooks.append(fn)
+
+def remove_metrics_hook(fn):
+    _hooks.remove(fn)
+
+def timed(stage):
+    """Decorator: add the function's run time to `stage` while profiling is on"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def timed_call(*args, **kwargs):
+            stats = active.get()
+            if stats is None:
+                return fn(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                stats.add_time(stage, time.perf_counter() - started)
+        return timed_call
+    return decorate
@@ -0,0 +1,580 @@
+"""Compact columnar event buffer used for recordings, and lazy arrangements of them"""
+from array import array
+from bisect import bisect_left
+import copy
+import hashlib
+import heapq
+import struct
+
+from instruments import music21_instrument, instrument_id
+from profiling import timed
+
+REST = -1                # pitch value used for rests
+DEFAULT_VELOCITY = 90    # what music21 writes for notes without an explicit velocity
+DRUM_CHANNEL = 9         # MIDI channel 10 (0-indexed) for percussion
+_COLUMNS = ('pitches', 'onsets', 'durations', 'velocities', 'channels')
+
+
+class Recording:
+    """A recording: an instrument plus one array per event field.
+
+    Events are stored column-wise (pitch, onset, duration, velocity, channel)
+    in `array` buffers, so recording a note is a handful of appends instead
+    of a music21 object. Offsets and durations are in beats (quarter notes).
+    Use .to_stream() to get the equivalent music21 Stream.
+    """
+
+    __slots__ = ('instrument', 'pitches', 'onsets', 'durations',
+                 'velocities', 'channels', 'length', '_sorted', '_index')
+
+    def __init__(self, instrument=None):
+        self.instrument = instrument        # InstrumentId or None
+        self.pitches = array('h')           # MIDI pitch, REST for rests
+        self.onsets = array('d')
+        self.durations = array('d')
+        self.velocities = array('B')
+        self.channels = array('B')
+        self.length = 0.0                   # end of the last event, like Stream.highestTime
+        self._sorted = True
+        self._index = None                  # _EndTree over the events, built on the first range query
+
+    def append(self, pitch, onset, duration, velocity=DEFAULT_VELOCITY, channel=0):
+        """Add one event (use pitch=REST for a rest)"""
+        if onset < 0 or duration < 0:
+            raise ValueError(f"Events need a non-negative onset and duration (got {onset}, {duration})")
+        if self.onsets and onset < self.onsets[-1]:
+            self._sorted = False
+        self.pitches.append(pitch)
+        self.onsets.append(onset)
+        self.durations.append(duration)
+        self.velocities.append(velocity)
+        self.channels.append(channel)
+        end = onset + duration
+        if end > self.length:
+            self.length = end
+
+    def extend(self, pitches, onsets, durations, velocity=DEFAULT_VELOCITY, channel=0):
+        """Add many events in one go (equal-length sequences; velocity and channel shared)"""
+        n = len(pitches)
+        if len(onsets) != n or len(durations) != n:
+            raise ValueError(f"pitches, onsets and durations must have the same length "
+                             f"(got {n}, {len(onsets)}, {len(durations)})")
+        if not n:
+            return
+        # Build every new chunk before touching a column, so a bad value leaves the recording unchanged
+        new_pitches = array('h', pitches)
+        new_onsets = array('d', onsets)
+        new_durations = array('d', durations)
+        new_velocities = array('B', [velocity]) * n
+        new_channels = array('B', [channel]) * n
+        if min(new_onsets) < 0 or min(new_durations) < 0:
+            raise ValueError("Events need non-negative onsets and durations")
+        previous = self.onsets[-1] if self.onsets else new_onsets[0]
+        if new_onsets[0] < previous or any(b < a for a, b in zip(new_onsets, new_onsets[1:])):
+            self._sorted = False
+        self.pitches.extend(new_pitches)
+        self.onsets.extend(new_onsets)
+        self.durations.extend(new_durations)
+        self.velocities.extend(new_velocities)
+        self.channels.extend(new_channels)
+        end = max(o + d for o, d in zip(new_onsets, new_durations))
+        if end > self.length:
+            self.length = end
+
+    def __len__(self):
+        return len(self.pitches)
+
+    def __iter__(self):
+        return self.events()
+
+    def __repr__(self):
+        name = self.instrument.name if self.instrument else None
+        return f"<Recording {name!r}: {len(self)} events, {self.length} beats>"
+
+    def _order(self):
+        """Event indices in onset order (stable, so same-onset events keep insertion order)"""
+        if self._sorted:
+            return range(len(self.pitches))
+        onsets = self.onsets
+        return sorted(range(len(onsets)), key=onsets.__getitem__)
+
+    def sort(self):
+        """Reorder the columns by onset in place (end_recording does this, so recordings arrive pre-sorted)"""
+        if self._sorted:
+            return
+        order = self._order()
+        for name in _COLUMNS:
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, map(column.__getitem__, order)))
+        self._sorted = True
+        self._index = None
+
+    def _interval_index(self):
+        """The end-time tree, brought up to date with any events appended since the last query"""
+        self.sort()
+        index = self._index
+        if index is None:
+            index = self._index = _EndTree()
+        onsets, durations = self.onsets, self.durations
+        for i in range(len(index), len(onsets)):
+            index.append(onsets[i] + durations[i])
+        return index
+
+    def slice(self, start, end):
+        """View of the events starting in [start, end), found by binary search (no copying).
+
+        Events keep their original onsets, and a note may run past `end`.
+        """
+        return RecordingView(self, start, end)
+
+    def split(self, offset):
+        """(events starting before offset, events starting at or after it), as two views"""
+        return RecordingView(self, float('-inf'), offset), RecordingView(self, offset, float('inf'))
+
+    def overlapping(self, start, end):
+        """Notes (no rests) sounding at any point in [start, end), in onset order"""
+        return self._overlapping(start, end, 0, len(self.pitches))
+
+    def _overlapping(self, start, end, lo, hi):
+        index = self._interval_index()
+        hi = min(hi, bisect_left(self.onsets, end))
+        p, o, d, v, c = self.pitches, self.onsets, self.durations, self.velocities, self.channels
+        return [(o[i], d[i], p[i], v[i], c[i]) for i in index.above(start, lo, hi)
+                if p[i] != REST and (o[i] + d[i] > start or (d[i] == 0 and o[i] >= start))]
+
+    def digest(self):
+        """Stable content hash (hex) of the instrument and every event, for caching renders"""
+        h = hashlib.sha256(repr(tuple(self.instrument) if self.instrument else None).encode())
+        h.update(struct.pack('<d', self.length))
+        order = None if self._sorted else self._order()
+        for column in (self.pitches, self.onsets, self.durations, self.velocities, self.channels):
+            if order is not None:
+                column = array(column.typecode, map(column.__getitem__, order))
+            h.update(column.tobytes())
+        return h.hexdigest()
+
+    def events(self):
+        """Yield (onset, duration, pitch, velocity, channel) for every event, rests included, by onset"""
+        p, o, d, v, c = self.pitches, self.onsets, self.durations, self.velocities, self.channels
+        for i in self._order():
+            yield o[i], d[i], p[i], v[i], c[i]
+
+    def notes(self):
+        """Like events() but without rests"""
+        for event in self.events():
+            if event[2] != REST:
+                yield event
+
+    def _fill(self, s):
+        """Add this recording's instrument and events to a music21 stream.
+
+        Events are already in onset order, so they go in with coreInsert and
+        the stream is re-sorted once at the end instead of on every insert.
+        """
+        from music21 import note
+
+        if self.instrument is not None:
+            # a copy, so callers can edit the stream's instrument without touching the shared one
+            s.coreInsert(0, copy.deepcopy(music21_instrument(self.instrument)))
+        for onset, duration, pitch, velocity, channel in self.events():
+            if pitch == REST:
+                n = note.Rest()
+            else:
+                n = note.Note(midi=pitch)
+                if velocity != DEFAULT_VELOCITY:
+                    n.volume.velocity = velocity
+                if channel == DRUM_CHANNEL:
+                    n.midiChannel = DRUM_CHANNEL
+            n.duration.quarterLength = duration
+            s.coreInsert(onset, n)
+        s.coreElementsChanged()
+        return s
+
+    @timed('stream_build')
+    def to_stream(self):
+        """Build the equivalent music21 Stream"""
+        from music21 import stream
+
+        return self._fill(stream.Stream())
+
+    @classmethod
+    def from_stream(cls, s):
+        """Build a Recording from a music21 Stream (first instrument, notes, chords and rests)"""
+        from music21 import instrument, note, chord
+
+        insts = s.getElementsByClass(instrument.Instrument)
+        rec = cls(instrument_id(insts[0]) if insts else None)
+        percussion = bool(rec.instrument and rec.instrument.percussion)
+        for element in s.flatten().notesAndRests:
+            onset = float(element.offset)
+            duration = float(element.duration.quarterLength)
+            if isinstance(element, note.Rest):
+                rec.append(REST, onset, duration)
+                continue
+            pitches = element.pitches if isinstance(element, chord.Chord) else (element.pitch,)
+            velocity = element.volume.velocity
+            if velocity is None:
+                velocity = DEFAULT_VELOCITY
+            channel = DRUM_CHANNEL if percussion else 0
+            for p in pitches:
+                rec.append(p.midi, onset, duration, velocity, channel)
+        return rec
+
+
+class RecordingView:
+    """A read-only window onto the events of a Recording that start in [start, end) (from slice/split).
+
+    Shares the recording's columns instead of copying them; events keep
+    their original onsets, so views of one recording can be played together
+    and line up. The window is defined by time, not by position: if the
+    recording is appended to or re-sorted later (a session still
+    recording), the view finds its events again by binary search the next
+    time it is used.
+    """
+
+    __slots__ = ('source', 'start', 'end', 'instrument', '_onsets', '_count', '_lo', '_hi', '_length')
+
+    def __init__(self, source, start, end):
+        self.source = source
+        self.start = start
+        self.end = max(start, end)
+        self.instrument = source.instrument
+        self._onsets = None     # the onsets column (and its size) _lo/_hi were found in
+
+    def _resolve(self):
+        """Index range of the window in the source's current columns"""
+        src = self.source
+        onsets = src.onsets
+        if onsets is not self._onsets or len(onsets) != self._count:
+            index = src._interval_index()    # sorts the source if needed
+            onsets = src.onsets
+            lo = bisect_left(onsets, self.start)
+            hi = bisect_left(onsets, self.end, lo)
+            self._lo, self._hi = lo, hi
+            self._length = max(index.range_max(lo, hi), 0.0)
+            self._onsets, self._count = onsets, len(onsets)
+        return self._lo, self._hi
+
+    @property
+    def lo(self):
+        return self._resolve()[0]
+
+    @property
+    def hi(self):
+        return self._resolve()[1]
+
+    @property
+    def length(self):
+        """End of the last event in the window (an absolute beat, like Recording.length)"""
+        self._resolve()
+        return self._length
+
+    def __len__(self):
+        lo, hi = self._resolve()
+        return hi - lo
+
+    def __iter__(self):
+        return self.events()
+
+    def __repr__(self):
+        name = self.instrument.name if self.instrument else None
+        return f"<RecordingView {name!r}: beats {self.start}-{self.end}, {len(self)} events>"
+
+    def events(self):
+        """Yield (onset, duration, pitch, velocity, channel) for every event, rests included, by onset"""
+        lo, hi = self._resolve()
+        src = self.source
+        p, o, d, v, c = src.pitches, src.onsets, src.durations, src.velocities, src.channels
+        for i in range(lo, hi):
+            yield o[i], d[i], p[i], v[i], c[i]
+
+    notes = Recording.notes
+    _fill = Recording._fill
+    to_stream = Recording.to_stream
+
+    def slice(self, start, end):
+        """Narrower view: the events in this one starting in [start, end)"""
+        return RecordingView(self.source, max(self.start, start), min(self.end, end))
+
+    def split(self, offset):
+        offset = min(max(offset, self.start), self.end)
+        return RecordingView(self.source, self.start, offset), RecordingView(self.source, offset, self.end)
+
+    def overlapping(self, start, end):
+        """Notes (no rests) in this view sounding at any point in [start, end), in onset order"""
+        lo, hi = self._resolve()
+        return self.source._overlapping(start, end, lo, hi)
+
+    def copy(self):
+        """The view's events as a new, editable Recording"""
+        lo, hi = self._resolve()
+        rec = Recording(self.instrument)
+        for name in _COLUMNS:
+            column = getattr(rec, name)
+            column.extend(getattr(self.source, name)[lo:hi])
+        rec.length = self.length
+        return rec
+
+    def digest(self):
+        h = hashlib.sha256(b'view' + repr(tuple(self.instrument) if self.instrument else None).encode())
+        lo, hi = self._resolve()
+        h.update(struct.pack('<d', self.length))
+        src = self.source
+        for column in (src.pitches, src.onsets, src.durations, src.velocities, src.channels):
+            h.update(column[lo:hi].tobytes())
+        return h.hexdigest()
+
+
+class _EndTree:
+    """Max segment tree over event end times, in onset order, grown one leaf at a time.
+
+    Level 0 holds the ends; each level above holds the max of pairs below.
+    Appending touches at most one node per level (O(log n)); the events
+    overlapping a range are found by descending only into subtrees whose
+    max end reaches past the range start.
+    """
+
+    __slots__ = ('_levels',)
+
+    def __init__(self):
+        self._levels = [array('d')]
+
+    def __len__(self):
+        return len(self._levels[0])
+
+    def append(self, end):
+        levels = self._levels
+        level = levels[0]
+        level.append(end)
+        i = len(level) - 1
+        k = 0
+        while len(level) > 1:
+            i >>= 1
+            value = max(level[2 * i], level[2 * i + 1]) if 2 * i + 1 < len(level) else level[2 * i]
+            if k + 1 == len(levels):
+                levels.append(array('d'))
+            parent = levels[k + 1]
+            if i == len(parent):
+                parent.append(value)
+            elif parent[i] >= value:
+                return
+            else:
+                parent[i] = value
+            level = parent
+            k += 1
+
+    def range_max(self, lo, hi):
+        """Largest end among leaves lo..hi-1 (-inf if the range is empty)"""
+        best = float('-inf')
+        for level in self._levels:
+            if lo >= hi:
+                break
+            if lo & 1:
+                best = max(best, level[lo])
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                best = max(best, level[hi])
+            lo >>= 1
+            hi >>= 1
+        return best
+
+    def above(self, threshold, lo, hi):
+        """Indices in [lo, hi), ascending, whose end is greater than threshold (or equal, for zero-length events)"""
+        levels = self._levels
+        found = []
+        if lo >= hi:
+            return found
+        stack = [(len(levels) - 1, 0)]
+        while stack:
+            k, i = stack.pop()
+            if (i << k) >= hi or ((i + 1) << k) <= lo or levels[k][i] < threshold:
+                continue
+            if k == 0:
+                found.append(i)
+                continue
+            child = len(levels[k - 1])
+            if 2 * i + 1 < child:
+                stack.append((k - 1, 2 * i + 1))
+            stack.append((k - 1, 2 * i))
+        return found
+
+
+class Arrangement:
+    """A recording built lazily from other recordings by repeat(), loop_until() and concat().
+
+    Holds references to its sources plus one (source, start, times, period,
+    end) segment per placement (start is added to the source's own onsets), so a 500-bar loop costs one segment rather
+    than 500 copies of the pattern. Events are produced on the fly, in onset
+    order, when it is exported or rendered; anything that takes a Recording
+    takes an Arrangement. Use .expand() for a concrete Recording.
+    """
+
+    __slots__ = ('instrument', 'segments', 'length', '_count')
+
+    def __init__(self, instrument, segments, length, count):
+        self.instrument = instrument
+        self.segments = tuple(segments)
+        self.length = length
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return self.events()
+
+    def __repr__(self):
+        name = self.instrument.name if self.instrument else None
+        return f"<Arrangement {name!r}: {len(self)} events, {self.length} beats, {len(self.segments)} segments>"
+
+    def events(self):
+        """Yield (onset, duration, pitch, velocity, channel) for every event, rests included, by onset"""
+        for source, start, times, period, end in self.segments:
+            for k in range(times):
+                base = start + k * period
+                for onset, duration, pitch, velocity, channel in source.events():
+                    onset += base
+                    if end is not None:
+                        if onset >= end:
+                            break
+                        duration = min(duration, end - onset)
+                    yield onset, duration, pitch, velocity, channel
+
+    notes = Recording.notes
+    _fill = Recording._fill
+    to_stream = Recording.to_stream
+
+    def expand(self):
+        """Materialize as a plain Recording"""
+        rec = Recording(self.instrument)
+        for onset, duration, pitch, velocity, channel in self.events():
+            rec.append(pitch, onset, duration, velocity, channel)
+        rec.length = self.length
+        return rec
+
+    def digest(self):
+        """Content hash from the sources' digests and the layout (no events are expanded)"""
+        h = hashlib.sha256(b'arrangement' + repr(tuple(self.instrument) if self.instrument else None).encode())
+        for source, start, times, period, end in self.segments:
+            h.update(source.digest().encode())
+            h.update(struct.pack('<dqdd', start, times, period, -1.0 if end is None else end))
+        return h.hexdigest()
+
+
+def _source(rec):
+    """(recording to hold by reference, origin, span) for an arrangement.
+
+    The recording is converted from music21 if needed and sorted so its
+    events merge in order. A view's events keep their absolute onsets, so
+    its origin is its first onset and its span runs from there to its end;
+    everything else plays from beat 0 for its full length.
+    """
+    rec = as_recording(rec)
+    if isinstance(rec, Recording):
+        rec.sort()
+    origin = 0.0
+    if isinstance(rec, RecordingView):
+        first = next(rec.events(), None)
+        if first is not None:
+            origin = first[0]
+    return rec, origin, rec.length - origin
+
+def _count_before(rec, beats):
+    """Number of rec's events with onset before beats"""
+    n = 0
+    for event in rec.events():
+        if event[0] >= beats:
+            break
+        n += 1
+    return n
+
+def repeat(recording, times):
+    """The recording played `times` times back to back, each copy starting at the previous one's end"""
+    if times < 0:
+        raise ValueError(f"times must be non-negative, not {times!r}")
+    rec, origin, span = _source(recording)
+    return Arrangement(rec.instrument, [(rec, -origin, times, span, None)], span * times, len(rec) * times)
+
+def loop_until(recording, beats):
+    """The recording looped to fill exactly `beats` beats; the last copy is cut off (notes clipped) at the end"""
+    rec, origin, span = _source(recording)
+    if span <= 0:
+        raise ValueError("Cannot loop a recording of length 0")
+    full, rest = divmod(beats, span)
+    full = int(full)
+    count = len(rec) * full
+    if rest > 0:
+        full += 1
+        count += _count_before(rec, origin + rest)
+    return Arrangement(rec.instrument, [(rec, -origin, full, span, float(beats))], float(beats), count)
+
+def concat(*recordings):
+    """The recordings one after another; they must share an instrument (or have none)"""
+    instrument = None
+    segments = []
+    start = 0.0
+    count = 0
+    for rec, origin, span in map(_source, recordings):
+        if rec.instrument is not None:
+            if instrument is not None and rec.instrument != instrument:
+                raise ValueError(f"Cannot concat recordings of different instruments "
+                                 f"({instrument.name} and {rec.instrument.name})")
+            instrument = rec.instrument
+        segments.append((rec, start - origin, 1, span, None))
+        start += span
+        count += len(rec)
+    return Arrangement(instrument, segments, start, count)
+
+def as_recording(obj):
+    """Pass Recordings through; convert music21 Streams with Recording.from_stream"""
+    if hasattr(obj, 'getElementsByClass'):
+        return Recording.from_stream(obj)
+    return obj
+
+
+@timed('score_build')
+def to_score(recordings, tempo_bpm=100):
+    """Build a music21 Score (tempo, 4/4, one Part per recording) like play_recordings used to"""
+    from music21 import stream, tempo, meter
+
+    score = stream.Score()
+    score.insert(0, tempo.MetronomeMark(number=tempo_bpm))
+    score.insert(0, meter.TimeSignature('4/4'))
+    for rec in recordings:
+        rec = as_recording(rec)
+        part = rec._fill(stream.Part())
+        # Percussion plays on MIDI channel 10 (9 in 0-indexed)
+        if rec.instrument is not None and rec.instrument.percussion:
+            part.midiChannel = DRUM_CHANNEL
+            part.midiProgram = 0
+            part.getInstrument(returnDefault=False).midiChannel = DRUM_CHANNEL
+        score.insert(0, part)
+    return score
+
+def merge_notes(recordings):
+    """k-way heap merge of the recordings' onset-sorted notes into one timeline.
+
+    Yields (onset, track, duration, pitch, velocity, channel) where track is
+    the recording's index in `recordings`.
+    """
+    def tagged(track, rec):
+        for onset, duration, pitch, velocity, channel in rec.notes():
+            yield onset, track, duration, pitch, velocity, channel
+    return heapq.merge(*(tagged(track, rec) for track, rec in enumerate(recordings)))
+
+def timeline(recordings):
+    """Merged note-on/note-off messages in time order.
+
+    Yields (beat, is_on, track, pitch, velocity, channel); at equal beats
+    note-offs come before note-ons so repeated pitches are not cut short.
+    Pending note-offs wait in a second heap until their time comes up.
+    """
+    offs = []
+    for onset, track, duration, pitch, velocity, channel in merge_notes(recordings):
+        while offs and offs[0][0] <= onset:
+            yield heapq.heappop(offs)
+        yield onset, 1, track, pitch, velocity, channel
+        heapq.heappush(offs, (onset + duration, 0, track, pitch, 0, channel))
+    while offs:
+        yield heapq.heappop(offs)
@@ -0,0 +1,343 @@
+"""Standard MIDI File encoding and decoding for recordings (no music21 needed)"""
+import struct
+import time
+
+import profiling
+from profiling import timed
+
+from instruments import PERCUSSION, instrument_for_program
+from recording import DRUM_CHANNEL, Recording, as_recording
+
+TICKS_PER_QUARTER = 480
+
+# Channel message status bytes (OR in the 0-15 channel)
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+PROGRAM_CHANGE = 0xC0
+_END_OF_TRACK = b'\xff\x2f\x00'
+
+def _varlen(value):
+    """MIDI variable-length quantity"""
+    assert value >= 0, value
+    out = bytearray((value & 0x7F,))
+    value >>= 7
+    while value:
+        out.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(out)
+
+def _chunk(kind, data):
+    return kind + struct.pack('>I', len(data)) + data
+
+def _meta(kind, data):
+    return b'\xff' + bytes((kind,)) + _varlen(len(data)) + data
+
+def _conductor_track(tempo_bpm):
+    """Track 0: tempo and a 4/4 time signature, like the MetronomeMark/TimeSignature on the score"""
+    us_per_quarter = round(60_000_000 / tempo_bpm)
+    data = (b'\x00' + _meta(0x51, us_per_quarter.to_bytes(3, 'big'))
+            + b'\x00' + _meta(0x58, bytes((4, 2, 24, 8)))
+            + b'\x00' + _END_OF_TRACK)
+    return _chunk(b'MTrk', data)
+
+def assign_channels(recordings):
+    """Drums get channel 10, everything else gets its own channel in order (skipping 10)"""
+    channels = []
+    next_channel = 0
+    for rec in recordings:
+        if rec.instrument is not None and rec.instrument.percussion:
+            channels.append(DRUM_CHANNEL)
+            continue
+        channels.append(next_channel)
+        next_channel = (next_channel + 1) % 16
+        if next_channel == DRUM_CHANNEL:
+            next_channel += 1
+    return channels
+
+def _note_track(rec, channel):
+    """Encode one recording as an MTrk chunk on the given channel"""
+    inst = rec.instrument
+    data = bytearray()
+    if inst is not None:
+        data += b'\x00' + _meta(0x03, inst.name.encode('latin-1', 'replace'))
+        if not inst.percussion and inst.program is not None:
+            data += bytes((0, PROGRAM_CHANGE | channel, inst.program))
+
+    # (tick, 0 = off / 1 = on / 2 = off of a zero-length note, pitch, velocity):
+    # sorting puts note-offs before note-ons on the same tick so repeated
+    # pitches are not cut short, but a zero-length note's off after its own on
+    events = []
+    for onset, duration, pitch, velocity, _ in rec.notes():
+        start = round(onset * TICKS_PER_QUARTER)
+        end = start + round(duration * TICKS_PER_QUARTER)
+        if start < 0 or end < start:
+            raise ValueError(f"Cannot encode a note at beat {onset} lasting {duration}; "
+                             f"onsets and durations must be non-negative")
+        events.append((start, 1, pitch, velocity))
+        events.append((end, 0 if end > start else 2, pitch, 0))
+    events.sort()
+
+    on_status = NOTE_ON | channel
+    off_status = NOTE_OFF | channel
+    last_tick = 0
+    running = None
+    for tick, is_on, pitch, velocity in events:
+        status = on_status if is_on else off_status
+        data += _varlen(tick - last_tick)
+        if status != running:
+            data.append(status)
+            running = status
+        data.append(pitch)
+        data.append(velocity)
+        last_tick = tick
+
+    end_tick = max(last_tick, round(rec.length * TICKS_PER_QUARTER))
+    data += _varlen(end_tick - last_tick) + _END_OF_TRACK
+    return _chunk(b'MTrk', bytes(data))
+
+@timed('midi_encode')
+def encode_midi(recordings, tempo_bpm=100):
+    """Encode recordings as a type-1 Standard MIDI File and return the bytes"""
+    recordings = [as_recording(rec) for rec in recordings]
+    header = _chunk(b'MThd', struct.pack('>HHH', 1, len(recordings) + 1, TICKS_PER_QUARTER))
+    tracks = [_note_track(rec, channel)
+              for rec, channel in zip(recordings, assign_channels(recordings))]
+    return header + _conductor_track(tempo_bpm) + b''.join(tracks)
+
+def write_midi(recordings, path_or_buffer, tempo_bpm=100):
+    """Write recordings as a type-1 MIDI file to a path or a binary file object; returns bytes written"""
+    return _write(encode_midi(recordings, tempo_bpm), path_or_buffer)
+
+def _write(data, path_or_buffer):
+    stats = profiling.active.get()
+    if stats:
+        started = time.perf_counter()
+    if hasattr(path_or_buffer, 'write'):
+        path_or_buffer.write(data)
+    else:
+        with open(path_or_buffer, 'wb') as f:
+            f.write(data)
+    if stats:
+        stats.record('midi_write', started, bytes_written=len(data))
+    return len(data)
+
+
+class MidiExportSession:
+    """Re-export the same set of recordings repeatedly, re-encoding only the tracks that changed.
+
+    Each export keeps every track's encoded MTrk chunk, keyed by the
+    recording's content hash and channel. A recording passed again as the
+    same object with the same event count and length is taken as unchanged
+    without hashing its events; anything else is hashed, so a re-recorded
+    but identical part is reused too. Only new or changed parts are encoded
+    before the file is reassembled, and the output is byte-identical to
+    encode_midi. Call mark_dirty(rec) after editing a recording's columns
+    in place.
+    """
+
+    def __init__(self, tempo_bpm=100):
+        self.tempo_bpm = tempo_bpm
+        self._tracks = {}       # (digest, channel) -> chunk
+        self._seen = {}         # id(recording) -> (recording, (len, length), digest)
+        self.encoded = self.reused = 0
+
+    def mark_dirty(self, recording):
+        """Forget what is known about recording so the next export hashes it again"""
+        self._seen.pop(id(recording), None)
+
+    def clear(self):
+        self._tracks.clear()
+        self._seen.clear()
+
+    def _digest(self, rec):
+        fingerprint = (len(rec), rec.length)
+        seen = self._seen.get(id(rec))
+        if seen is not None and seen[0] is rec and seen[1] == fingerprint:
+            return seen[2]
+        digest = rec.digest()
+        self._seen[id(rec)] = (rec, fingerprint, digest)
+        return digest
+
+    @timed('midi_encode')
+    def encode(self, recordings, tempo_bpm=None):
+        """Like encode_midi, reusing the chunks of unchanged tracks"""
+        recordings = [as_recording(rec) for rec in recordings]
+        tempo_bpm = self.tempo_bpm if tempo_bpm is None else tempo_bpm
+        tracks = {}
+        seen = {}
+        chunks = []
+        encoded = 0
+        for rec, channel in zip(recordings, assign_channels(recordings)):
+            digest = self._digest(rec)
+            seen[id(rec)] = self._seen[id(rec)]
+            key = (digest, channel)
+            chunk = tracks.get(key) or self._tracks.get(key)
+            if chunk is None:
+                chunk = _note_track(rec, channel)
+                encoded += 1
+            tracks[key] = chunk
+            chunks.append(chunk)
+        # keep only what the latest export used, so memory tracks the current piece
+        self._tracks = tracks
+        self._seen = seen
+        self.encoded += encoded
+        self.reused += len(chunks) - encoded
+        stats = profiling.active.get()
+        if stats:
+            stats.count('tracks_encoded', encoded)
+            stats.count('tracks_reused', len(chunks) - encoded)
+        header = _chunk(b'MThd', struct.pack('>HHH', 1, len(recordings) + 1, TICKS_PER_QUARTER))
+        return header + _conductor_track(tempo_bpm) + b''.join(chunks)
+
+    def write(self, recordings, path_or_buffer, tempo_bpm=None):
+        """Like write_midi, through this session; returns bytes written"""
+        return _write(self.encode(recordings, tempo_bpm), path_or_buffer)
+
+
+# Reading: SMF -> Recordings, straight from the bytes (no music21)
+
+_DATA_BYTES = {0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2}
+
+def _read_exactly(f, n, what):
+    data = f.read(n)
+    if len(data) < n:
+        raise ValueError(f"Truncated MIDI file: {what} is cut short")
+    return data
+
+def _read_track(data, division, recordings):
+    """Parse one MTrk body, appending a Recording per channel (and per program) to recordings"""
+    current = {}        # channel -> Recording notes on that channel go into
+    programs = {}       # channel -> program in effect
+    held = {}           # (channel, pitch) -> [(recording, event index), ...] waiting for their note-off
+    tick = 0
+    i = 0
+    n = len(data)
+    status = None
+    while i < n:
+        # delta time (variable-length quantity)
+        byte = data[i]
+        i += 1
+        delta = byte & 0x7F
+        while byte & 0x80:
+            byte = data[i]
+            i += 1
+            delta = (delta << 7) | (byte & 0x7F)
+        tick += delta
+
+        byte = data[i]
+        if byte & 0x80:
+            status = byte
+            i += 1
+        elif status is None:
+            raise ValueError("Corrupt MIDI track: data byte without a status byte")
+
+        if status >= 0xF0:
+            if status == 0xFF:
+                kind = data[i]
+                i += 1
+            # meta (FF type len data) and sysex (F0/F7 len data) events: skip the payload
+            byte = data[i]
+            i += 1
+            length = byte & 0x7F
+            while byte & 0x80:
+                byte = data[i]
+                i += 1
+                length = (length << 7) | (byte & 0x7F)
+            i += length
+            if status == 0xFF and kind == 0x2F:
+                break
+            status = None   # running status does not survive meta/sysex events
+            continue
+
+        kind = status & 0xF0
+        channel = status & 0x0F
+        if kind == NOTE_ON or kind == NOTE_OFF:
+            pitch = data[i]
+            velocity = data[i + 1]
+            i += 2
+            key = (channel, pitch)
+            if kind == NOTE_ON and velocity:
+                rec = current.get(channel)
+                if rec is None:
+                    if channel == DRUM_CHANNEL:
+                        inst = PERCUSSION
+                    else:
+                        inst = instrument_for_program(programs.get(channel, 0))
+                    rec = current[channel] = Recording(inst)
+                    recordings.append(rec)
+                held.setdefault(key, []).append((rec, len(rec.pitches)))
+                rec.append(pitch, tick / division, 0.0, velocity,
+                           DRUM_CHANNEL if channel == DRUM_CHANNEL else 0)
+            else:
+                waiting = held.get(key)
+                if waiting:
+                    rec, index = waiting.pop(0)
+                    _end_note(rec, index, tick / division)
+        elif kind == PROGRAM_CHANGE:
+            program = data[i]
+            i += 1
+            if programs.get(channel, 0) != program:
+                programs[channel] = program
+                current.pop(channel, None)  # later notes start a new recording
+        else:
+            i += _DATA_BYTES[kind]
+        if i > n:
+            raise ValueError("Corrupt MIDI track: event runs past the end of the track")
+
+    end = tick / division
+    for waiting in held.values():   # notes never turned off end with the track
+        for rec, index in waiting:
+            _end_note(rec, index, end)
+    return end
+
+def _end_note(rec, index, beat):
+    duration = beat - rec.onsets[index]
+    rec.durations[index] = duration
+    if beat > rec.length:
+        rec.length = beat
+
+@timed('midi_read')
+def read_midi(path_or_buffer):
+    """Read a Standard MIDI File (path or binary file object) into Recordings.
+
+    Tracks are read one chunk at a time and parsed straight into event
+    columns. Each track gives one Recording per channel it plays on (and a
+    new one when a program change switches that channel's instrument);
+    channel 10 becomes a percussion recording like play_drum makes. Onsets
+    and durations are in beats, so tempo changes are not applied.
+    """
+    if hasattr(path_or_buffer, 'read'):
+        return _read_midi(path_or_buffer)
+    with open(path_or_buffer, 'rb') as f:
+        return _read_midi(f)
+
+def _read_midi(f):
+    header = _read_exactly(f, 8, "header")
+    if header[:4] != b'MThd':
+        raise ValueError("Not a Standard MIDI File (no MThd header)")
+    length = struct.unpack('>I', header[4:])[0]
+    _, n_tracks, division = struct.unpack('>HHH', _read_exactly(f, length, "header")[:6])
+    if division & 0x8000:
+        raise ValueError("SMPTE time division is not supported; only ticks per quarter note")
+    recordings = []
+    stats = profiling.active.get()
+    for _ in range(n_tracks):
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            break   # fewer tracks than the header claims: keep what was read
+        kind, length = chunk[:4], struct.unpack('>I', chunk[4:])[0]
+        data = _read_exactly(f, length, "track")
+        if kind != b'MTrk':
+            continue    # unknown chunks are skipped, as the spec asks
+        first = len(recordings)
+        try:
+            end = _read_track(data, division, recordings)
+        except IndexError:
+            raise ValueError("Corrupt MIDI track: event runs past the end of the track") from None
+        for rec in recordings[first:]:
+            rec.sort()
+            if end > rec.length:
+                rec.length = end
+        if stats:
+            stats.count('bytes_read', 8 + length)
+    return recordings
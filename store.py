@@ -0,0 +1,205 @@
+"""Compact binary files for recordings, loadable lazily through mmap.
+
+A .rec file is a small header (magic, format version, instrument, event
+count, length) followed by the event columns as raw little-endian arrays,
+each aligned to 8 bytes:
+
+    onsets f64[n] | durations f64[n] | pitches i16[n] | velocities u8[n] | channels u8[n]
+
+load_recording only reads the header; the columns are loaded as
+memoryviews when the events are first used (for example while
+play_recordings encodes them), memory-mapped if the file is large.
+"""
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from instruments import InstrumentId
+from recording import Recording, as_recording
+
+MAGIC = b'MREC'
+FORMAT_VERSION = 1
+_HEADER = struct.Struct('<4sHHQdhH')    # magic, version, flags, events, length, program, name bytes
+_HAS_INSTRUMENT = 1
+_PERCUSSION = 2
+_COLUMNS = (('onsets', 'd'), ('durations', 'd'), ('pitches', 'h'), ('velocities', 'B'), ('channels', 'B'))
+_NATIVE = sys.byteorder == 'little'
+MMAP_MIN_BYTES = 1 << 20    # smaller files are read into memory rather than mapped, so they hold no descriptor
+
+
+def _padding(offset):
+    return -offset % 8
+
+
+class MappedRecording(Recording):
+    """A read-only Recording backed by a .rec file, whose columns are loaded on first use.
+
+    Opening one only reads the header. The first time the events are
+    needed, a small file is read into memory in one go and a large one
+    (MMAP_MIN_BYTES or more) is memory-mapped, so the columns are
+    memoryviews either way and only large stems hold a file descriptor.
+    Pickling one pickles its path; the copy reopens the file.
+    """
+
+    __slots__ = ('path', '_count', '_offset', '_buffer')
+
+    def __init__(self, path, instrument, count, length, offset):
+        self.path = path
+        self.instrument = instrument
+        self.length = length
+        self._sorted = True
+        self._index = None
+        self._count = count
+        self._offset = offset
+        self._buffer = None
+
+    def __len__(self):
+        return self._count
+
+    def __reduce__(self):
+        return load_recording, (self.path,)
+
+    def _load(self):
+        """Read or map the file and point the columns at it"""
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size >= MMAP_MIN_BYTES:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buffer = f.read()
+        offset = self._offset
+        view = memoryview(buffer)
+        for name, typecode in _COLUMNS:
+            nbytes = self._count * struct.calcsize(typecode)
+            if offset + nbytes > len(buffer):
+                raise ValueError(f"{self.path} is truncated")
+            getattr(Recording, name).__set__(self, view[offset:offset + nbytes].cast(typecode))
+            offset += nbytes + _padding(nbytes)
+        self._buffer = buffer
+
+    def append(self, *args, **kwargs):
+        raise TypeError("Loaded recordings are read-only; use .copy() for an editable Recording")
+
+    extend = append
+
+    def copy(self):
+        """An ordinary, editable Recording with the same events"""
+        rec = Recording(self.instrument)
+        for name, typecode in _COLUMNS:
+            setattr(rec, name, array(typecode, getattr(self, name)))
+        rec.length = self.length
+        return rec
+
+
+def _lazy_column(name):
+    slot = getattr(Recording, name)
+
+    def get(self):
+        try:
+            return slot.__get__(self)
+        except AttributeError:
+            self._load()
+            return slot.__get__(self)
+    return property(get)
+
+for _name, _ in _COLUMNS:
+    setattr(MappedRecording, _name, _lazy_column(_name))
+del _name
+
+
+def save_recording(recording, path):
+    """Write a recording (Recording, Arrangement or music21 Stream) to a .rec file; returns bytes written"""
+    rec = as_recording(recording)
+    if not isinstance(rec, Recording) or not rec._sorted:
+        rec = _sorted_copy(rec)
+    inst = rec.instrument
+    name = inst.name.encode('utf-8') if inst is not None else b''
+    flags = 0
+    if inst is not None:
+        flags |= _HAS_INSTRUMENT
+        if inst.percussion:
+            flags |= _PERCUSSION
+    program = inst.program if inst is not None and inst.program is not None else -1
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, flags, len(rec), rec.length, program, len(name)) + name
+    written = 0
+    with open(path, 'wb') as f:
+        written += f.write(header + b'\0' * _padding(len(header)))
+        for column_name, typecode in _COLUMNS:
+            column = getattr(rec, column_name)
+            if not _NATIVE:
+                column = array(typecode, column)
+                column.byteswap()
+            data = column.tobytes()
+            written += f.write(data + b'\0' * _padding(len(data)))
+    return written
+
+def _sorted_copy(rec):
+    copy = Recording(rec.instrument)
+    for onset, duration, pitch, velocity, channel in rec.events():
+        copy.append(pitch, onset, duration, velocity, channel)
+    copy.length = rec.length
+    return copy
+
+def _read_header(buffer, path):
+    if len(buffer) < _HEADER.size:
+        raise ValueError(f"{path} is not a recording file (too short)")
+    magic, version, flags, count, length, program, name_len = _HEADER.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a recording file")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"{path} uses recording format version {version}; this code reads version {FORMAT_VERSION}")
+    name = bytes(buffer[_HEADER.size:_HEADER.size + name_len]).decode('utf-8')
+    instrument = None
+    if flags & _HAS_INSTRUMENT:
+        instrument = InstrumentId(None if program < 0 else program, name, bool(flags & _PERCUSSION))
+    offset = _HEADER.size + name_len
+    return instrument, count, length, offset + _padding(offset)
+
+def load_recording(path, mmap_file=True):
+    """Open a .rec file.
+
+    By default only the header is read and a read-only MappedRecording is
+    returned; its events are loaded (memory-mapped if the file is large)
+    when first used. Pass mmap_file=False to read the whole file into an
+    ordinary (editable) Recording instead.
+    """
+    with open(path, 'rb') as f:
+        if not mmap_file or not _NATIVE:
+            return _read_recording(f.read(), path)
+        head = f.read(_HEADER.size)
+        if len(head) == _HEADER.size:
+            head += f.read(_HEADER.unpack(head)[-1])
+        size = os.fstat(f.fileno()).st_size
+    instrument, count, length, offset = _read_header(head, path)
+    if offset + _columns_bytes(count) > size:
+        raise ValueError(f"{path} is truncated")
+    return MappedRecording(os.path.abspath(path), instrument, count, length, offset)
+
+def _columns_bytes(count):
+    total = 0
+    for _, typecode in _COLUMNS:
+        nbytes = count * struct.calcsize(typecode)
+        total += nbytes + _padding(nbytes)
+    return total
+
+def _read_recording(data, path):
+    instrument, count, length, offset = _read_header(data, path)
+    rec = Recording(instrument)
+    for name, typecode in _COLUMNS:
+        column = array(typecode)
+        size = count * column.itemsize
+        if offset + size > len(data):
+            raise ValueError(f"{path} is truncated")
+        column.frombytes(data[offset:offset + size])
+        if not _NATIVE:
+            column.byteswap()
+        setattr(rec, name, column)
+        offset += size + _padding(size)
+    rec.length = length
+    return rec
+
+def load_recordings(paths, mmap_file=True):
+    """load_recording for each path, e.g. to pass thousands of stems straight to play_recordings"""
+    return [load_recording(path, mmap_file) for path in paths]
@@ -0,0 +1,408 @@
+"""Offline audio rendering of recordings with NumPy (no MIDI player needed).
+
+Each note is synthesized as a whole vector: a few oscillator layers chosen
+by the instrument's GM family, an ADSR envelope, then mixed into the output
+at its start sample. Drums use synthesized voices for the play_drum kit.
+Mixing runs block by block (iter_blocks), so long pieces can be streamed to
+disk or a pipe with stream_wav, or rendered as memory-mapped WAV stems
+(render_stems) and summed into a master in place (mix_stems).
+"""
+from collections import namedtuple
+import struct
+import time
+import wave
+
+import numpy as np
+
+import profiling
+from recording import as_recording, merge_notes
+
+SAMPLE_RATE = 44100
+MASTER_GAIN = 0.25   # per voice, before the final peak normalization
+BLOCK_SIZE = 1024    # frames per block when streaming
+_WAV_HEADER_BYTES = 44
+
+# layers: (oscillator, frequency ratio, level, detune in cents); times in seconds
+Voice = namedtuple('Voice', ['layers', 'attack', 'decay', 'sustain', 'release', 'drive', 'noise'],
+                   defaults=(0.0, 0.0))
+
+def _sine(phase):
+    return np.sin(2 * np.pi * phase)
+
+def _saw(phase):
+    return 2.0 * (phase - np.floor(phase + 0.5))
+
+def _square(phase):
+    return np.where(phase % 1.0 < 0.5, 1.0, -1.0)
+
+def _triangle(phase):
+    return 2.0 * np.abs(_saw(phase)) - 1.0
+
+# GM program (0-indexed) -> voice
+_VOICES = {
+    # Bass: 38 Synth Bass 1, 39 Synth Bass 2
+    38: Voice([(_saw, 1, 0.7, 0), (_square, 0.5, 0.3, 0)], 0.005, 0.2, 0.6, 0.05),
+    39: Voice([(_square, 1, 0.6, 0), (_saw, 1, 0.4, 5)], 0.005, 0.15, 0.5, 0.05, drive=1.5),
+    # Strings: 50 Synth Strings 1, 51 Synth Strings 2
+    50: Voice([(_saw, 1, 0.4, -8), (_saw, 1, 0.4, 8), (_saw, 2, 0.2, 0)], 0.15, 0.2, 0.85, 0.3),
+    51: Voice([(_saw, 1, 0.5, -5), (_triangle, 1, 0.5, 5)], 0.25, 0.2, 0.8, 0.4),
+    # Leads: 80-87
+    80: Voice([(_saw, 1, 1.0, 0)], 0.005, 0.1, 0.8, 0.08),
+    81: Voice([(_saw, 1, 0.5, -7), (_saw, 1, 0.5, 7)], 0.005, 0.1, 0.8, 0.08),
+    82: Voice([(_square, 1, 0.8, 0), (_sine, 2, 0.2, 0)], 0.01, 0.1, 0.8, 0.1),
+    83: Voice([(_square, 1, 0.8, 0)], 0.005, 0.08, 0.7, 0.08, noise=0.5),
+    84: Voice([(_saw, 1, 1.0, 0)], 0.005, 0.1, 0.8, 0.08, drive=3.0),
+    85: Voice([(_sine, 1, 0.7, 0), (_triangle, 2, 0.3, 3)], 0.05, 0.1, 0.9, 0.15),
+    86: Voice([(_saw, 1, 0.6, 0), (_saw, 1.5, 0.4, 0)], 0.005, 0.1, 0.8, 0.08),
+    87: Voice([(_saw, 1, 0.6, 0), (_saw, 0.5, 0.4, 0)], 0.005, 0.1, 0.8, 0.08),
+    # Pads: 88-95
+    88: Voice([(_sine, 1, 0.6, 0), (_triangle, 2, 0.25, 4), (_sine, 4, 0.15, 0)], 0.3, 0.5, 0.7, 0.8),
+    89: Voice([(_triangle, 1, 0.5, -6), (_triangle, 1, 0.5, 6)], 0.4, 0.3, 0.9, 0.8),
+    90: Voice([(_saw, 1, 0.4, -10), (_saw, 1, 0.4, 10), (_square, 0.5, 0.2, 0)], 0.1, 0.3, 0.7, 0.5),
+    91: Voice([(_sine, 1, 0.6, -4), (_sine, 1, 0.4, 4), (_triangle, 2, 0.2, 0)], 0.35, 0.3, 0.9, 0.8),
+    92: Voice([(_triangle, 1, 0.7, 0), (_saw, 1, 0.3, 3)], 0.4, 0.3, 0.8, 0.7),
+    93: Voice([(_sine, 1, 0.5, 0), (_sine, 2.76, 0.3, 0), (_sine, 5.4, 0.2, 0)], 0.2, 0.6, 0.6, 0.9),
+    94: Voice([(_sine, 1, 0.5, -7), (_sine, 1, 0.3, 7), (_sine, 2, 0.2, 0)], 0.5, 0.4, 0.8, 1.2),
+    95: Voice([(_saw, 1, 0.5, -12), (_saw, 1, 0.5, 12)], 0.6, 0.5, 0.8, 1.0),
+}
+
+# Everything else (piano, guitar, winds, ...) gets a plain decaying keyboard-like tone
+_DEFAULT_VOICE = Voice([(_triangle, 1, 0.7, 0), (_sine, 2, 0.3, 0)], 0.005, 1.0, 0.3, 0.15)
+
+def voice_for(inst_id):
+    """The Voice used for an instrument (None for percussion, which uses drum voices)"""
+    if inst_id is not None and inst_id.percussion:
+        return None
+    program = inst_id.program if inst_id is not None else None
+    return _VOICES.get(program, _DEFAULT_VOICE)
+
+def _frequency(pitch):
+    return 440.0 * 2.0 ** ((pitch - 69) / 12.0)
+
+def _envelope(voice, n_held, n_total, sample_rate):
+    """ADSR: attack/decay/sustain while held, then a linear release from wherever it got to"""
+    t = np.arange(n_total) / sample_rate
+    attack = max(voice.attack, 1e-3)
+    env = np.interp(t, (0.0, attack, attack + voice.decay), (0.0, 1.0, voice.sustain))
+    if n_total > n_held:
+        level = env[n_held - 1] if n_held else 0.0
+        env[n_held:] = level * np.linspace(1.0, 0.0, n_total - n_held)
+    return env
+
+def _render_tone(voice, pitch, velocity, seconds, sample_rate, rng):
+    """One pitched note, including its release tail"""
+    n_held = max(int(seconds * sample_rate), 1)
+    n_total = n_held + int(voice.release * sample_rate)
+    t = np.arange(n_total) / sample_rate
+    base = _frequency(pitch)
+    out = np.zeros(n_total)
+    for oscillator, ratio, level, cents in voice.layers:
+        out += level * oscillator(base * ratio * 2.0 ** (cents / 1200.0) * t)
+    if voice.noise:
+        out += voice.noise * rng.standard_normal(n_total) * np.exp(-t / 0.02)
+    if voice.drive:
+        out = np.tanh(voice.drive * out) / np.tanh(voice.drive)
+    return out * _envelope(voice, n_held, n_total, sample_rate) * (velocity / 127.0)
+
+def _noise(rng, n, bright=False):
+    noise = rng.standard_normal(n)
+    if bright:  # first difference: crude high-pass for cymbals
+        noise = np.diff(noise, prepend=0.0)
+    return noise
+
+# How long each drum rings, in seconds (duration is ignored for drums)
+_DRUM_SECONDS = {35: 0.5, 36: 0.5, 38: 0.25, 40: 0.25, 42: 0.08, 44: 0.08, 46: 0.5,
+                 49: 1.5, 52: 1.5, 55: 1.5, 57: 1.5, 51: 1.2, 53: 1.2, 59: 1.2,
+                 41: 0.4, 43: 0.4, 45: 0.4, 47: 0.4, 48: 0.4, 50: 0.4}
+_DEFAULT_DRUM_SECONDS = 0.15
+
+def _render_drum(pitch, velocity, sample_rate, rng):
+    """Synthesized GM percussion"""
+    t = np.arange(int(_DRUM_SECONDS.get(pitch, _DEFAULT_DRUM_SECONDS) * sample_rate)) / sample_rate
+    if pitch in (35, 36):                                  # kick: falling sine
+        freq = 50.0 + 100.0 * np.exp(-t / 0.04)
+        out = np.sin(2 * np.pi * np.cumsum(freq) / sample_rate) * np.exp(-t / 0.15)
+    elif pitch in (38, 40):                                # snare: noise plus body tone
+        out = (0.7 * _noise(rng, len(t)) * np.exp(-t / 0.06)
+               + 0.4 * np.sin(2 * np.pi * 185.0 * t) * np.exp(-t / 0.08))
+    elif pitch in (42, 44):                                # closed / pedal hi-hat
+        out = 0.5 * _noise(rng, len(t), bright=True) * np.exp(-t / 0.02)
+    elif pitch == 46:                                      # open hi-hat
+        out = 0.5 * _noise(rng, len(t), bright=True) * np.exp(-t / 0.15)
+    elif pitch in (49, 52, 55, 57):                        # crash
+        out = 0.5 * _noise(rng, len(t), bright=True) * np.exp(-t / 0.5)
+    elif pitch in (51, 53, 59):                            # ride: noise plus bell
+        out = (0.3 * _noise(rng, len(t), bright=True) * np.exp(-t / 0.4)
+               + 0.2 * np.sin(2 * np.pi * 620.0 * t) * np.exp(-t / 0.6))
+    elif pitch in (41, 43, 45, 47, 48, 50):                # toms: pitched falling sine
+        freq = _frequency(pitch) * (1.0 + 0.5 * np.exp(-t / 0.03))
+        out = np.sin(2 * np.pi * np.cumsum(freq) / sample_rate) * np.exp(-t / 0.12)
+    else:                                                  # anything else: short noise hit
+        out = 0.5 * _noise(rng, len(t)) * np.exp(-t / 0.04)
+    return out * (velocity / 127.0)
+
+def render_note(voice, pitch, velocity, seconds, sample_rate, seed):
+    """Samples for one note; voice None means a drum hit"""
+    rng = np.random.default_rng(seed)
+    if voice is None:
+        return _render_drum(pitch, velocity, sample_rate, rng)
+    return _render_tone(voice, pitch, velocity, seconds, sample_rate, rng)
+
+def note_length(voice, pitch, seconds, sample_rate):
+    """Number of samples render_note will return, without rendering it"""
+    if voice is None:
+        return int(_DRUM_SECONDS.get(pitch, _DEFAULT_DRUM_SECONDS) * sample_rate)
+    return max(int(seconds * sample_rate), 1) + int(voice.release * sample_rate)
+
+def _note_cursor(recordings, seconds_per_beat, sample_rate):
+    """All notes of all recordings in onset order: (start sample, voice, pitch, velocity, seconds)"""
+    voices = [voice_for(rec.instrument) for rec in recordings]
+    for onset, track, duration, pitch, velocity, _ in merge_notes(recordings):
+        yield (int(round(onset * seconds_per_beat * sample_rate)), voices[track], pitch, velocity,
+               duration * seconds_per_beat)
+
+def _total_samples(recordings, seconds_per_beat, sample_rate):
+    """Length of the rendered piece: the recordings' length or the end of the last tail, whichever is later"""
+    total = int(max((rec.length for rec in recordings), default=0.0) * seconds_per_beat * sample_rate)
+    for start, voice, pitch, _, seconds in _note_cursor(recordings, seconds_per_beat, sample_rate):
+        total = max(total, start + note_length(voice, pitch, seconds, sample_rate))
+    return total
+
+def iter_blocks(recordings, tempo_bpm=100, sample_rate=SAMPLE_RATE, block_size=BLOCK_SIZE):
+    """Render recordings as a stream of float32 blocks of block_size frames (the last may be shorter).
+
+    Notes are taken from an onset-sorted cursor over all recordings and only
+    the voices sounding in the current block are kept, so memory stays flat
+    however long the piece is. Samples are scaled by MASTER_GAIN but not
+    normalized, so loud mixes can exceed [-1, 1].
+    """
+    recordings = [as_recording(rec) for rec in recordings]
+    seconds_per_beat = 60.0 / tempo_bpm
+    total = int(max((rec.length for rec in recordings), default=0.0) * seconds_per_beat * sample_rate)
+    cursor = _note_cursor(recordings, seconds_per_beat, sample_rate)
+    pending = next(cursor, None)
+    active = []          # (start sample, samples) for every voice still sounding
+    last_end = 0
+    block_start = 0
+    while True:
+        stats = profiling.active.get()
+        if stats:
+            started = time.perf_counter()
+        block_end = block_start + block_size
+        while pending is not None and pending[0] < block_end:
+            start, voice, pitch, velocity, seconds = pending
+            samples = render_note(voice, pitch, velocity, seconds, sample_rate, seed=(start, pitch))
+            active.append((start, samples))
+            last_end = max(last_end, start + len(samples))
+            pending = next(cursor, None)
+
+        block = np.zeros(block_size)
+        sounding = []
+        for start, samples in active:
+            lo = max(block_start - start, 0)
+            hi = min(block_end - start, len(samples))
+            if hi > lo:
+                block[start + lo - block_start:start + hi - block_start] += samples[lo:hi]
+            if start + len(samples) > block_end:
+                sounding.append((start, samples))
+        active = sounding
+
+        n = block_size
+        if pending is None and not active:
+            n = min(block_size, max(total, last_end) - block_start)
+            if n <= 0:
+                return
+        block = (block[:n] * MASTER_GAIN).astype(np.float32)
+        if stats:
+            stats.record('audio_render', started)
+        yield block
+        if n < block_size:
+            return
+        block_start = block_end
+
+def render_audio(recordings, tempo_bpm=100, sample_rate=SAMPLE_RATE):
+    """Mix recordings into one mono float32 array, normalized to [-1, 1] if it would clip"""
+    blocks = list(iter_blocks(recordings, tempo_bpm, sample_rate))
+    mix = np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.float32)
+    peak = np.abs(mix).max() if len(mix) else 0.0
+    if peak > 0.99:
+        mix *= 0.99 / peak
+    return mix
+
+def to_pcm16(samples):
+    """float samples in [-1, 1] -> little-endian 16-bit PCM bytes"""
+    return (np.clip(samples, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+
+def write_wav(recordings, path_or_buffer, tempo_bpm=100, sample_rate=SAMPLE_RATE):
+    """Render recordings and save them as a mono 16-bit WAV file (path or binary file object)"""
+    samples = render_audio(recordings, tempo_bpm, sample_rate)
+    with wave.open(path_or_buffer, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(to_pcm16(samples))
+    stats = profiling.active.get()
+    if stats:
+        stats.count('bytes_written', _WAV_HEADER_BYTES + 2 * len(samples))
+    return len(samples)
+
+def stream_wav(recordings, path_or_buffer, tempo_bpm=100, sample_rate=SAMPLE_RATE, block_size=BLOCK_SIZE):
+    """Render recordings block by block straight into a WAV file, path, or pipe.
+
+    Unlike write_wav the whole piece is never held in memory; the frame
+    count is worked out up front so non-seekable outputs (pipes, sockets)
+    work too. Samples that would clip are clipped rather than normalized.
+    Returns the number of frames written.
+    """
+    recordings = [as_recording(rec) for rec in recordings]
+    frames = _total_samples(recordings, 60.0 / tempo_bpm, sample_rate)
+    with wave.open(path_or_buffer, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.setnframes(frames)
+        for block in iter_blocks(recordings, tempo_bpm, sample_rate, block_size):
+            w.writeframesraw(to_pcm16(block))  # writeframes would seek back to patch the header
+    stats = profiling.active.get()
+    if stats:
+        stats.count('bytes_written', _WAV_HEADER_BYTES + 2 * frames)
+    return frames
+
+
+# Memory-mapped output: stems and mixes are written straight into preallocated
+# WAV files through np.memmap, so only the current block is ever in RAM.
+
+_WAV_FORMATS = {np.dtype('<i2'): (1, 16), np.dtype('<f4'): (3, 32)}   # dtype -> (format tag, bits)
+_MIX_BLOCK = 1 << 20    # frames per step when mixing stems
+
+def _wav_header(frames, sample_rate, dtype):
+    """RIFF header for a mono WAV of the given sample dtype (float WAVs get the fact chunk they need)"""
+    tag, bits = _WAV_FORMATS[dtype]
+    data_bytes = frames * dtype.itemsize
+    if tag == 1:
+        fmt = struct.pack('<HHIIHH', tag, 1, sample_rate, sample_rate * dtype.itemsize, dtype.itemsize, bits)
+        extra = b''
+    else:
+        fmt = struct.pack('<HHIIHHH', tag, 1, sample_rate, sample_rate * dtype.itemsize, dtype.itemsize, bits, 0)
+        extra = b'fact' + struct.pack('<II', 4, frames)
+    body = b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt + extra + b'data' + struct.pack('<I', data_bytes)
+    return b'RIFF' + struct.pack('<I', len(body) + data_bytes) + body
+
+def create_wav_memmap(path, frames, sample_rate=SAMPLE_RATE, dtype='float32'):
+    """Preallocate a silent mono WAV of `frames` samples and return a writable memmap over its data.
+
+    dtype is 'float32' (default; mixes in place without clipping) or 'int16'.
+    """
+    dtype = np.dtype(dtype).newbyteorder('<')
+    if dtype not in _WAV_FORMATS:
+        raise ValueError(f"WAV memmap dtype must be float32 or int16, not {dtype}")
+    header = _wav_header(frames, sample_rate, dtype)
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.truncate(len(header) + frames * dtype.itemsize)   # sparse zeros on most filesystems
+    if not frames:
+        return np.zeros(0, dtype)
+    return np.memmap(path, dtype=dtype, mode='r+', offset=len(header), shape=(frames,))
+
+def open_wav_memmap(path, mode='r'):
+    """Map the samples of a mono 16-bit or float32 WAV file; returns (memmap, sample_rate).
+
+    The default mode 'r' opens it read-only, so later stages can share stems
+    without copying them; use 'r+' to modify in place.
+    """
+    with open(path, 'rb') as f:
+        riff = f.read(12)
+        if riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+            raise ValueError(f"{path} is not a WAV file")
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                raise ValueError(f"{path} has no data chunk")
+            name, size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+            if name == b'data':
+                offset = f.tell()
+                break
+            payload = f.read(size + (size & 1))
+            if name == b'fmt ':
+                fmt = struct.unpack('<HHIIHH', payload[:16])
+    if fmt is None:
+        raise ValueError(f"{path} has no fmt chunk")
+    tag, channels, sample_rate, _, _, bits = fmt
+    dtype = next((dt for dt, spec in _WAV_FORMATS.items() if spec == (tag, bits)), None)
+    if dtype is None or channels != 1:
+        raise ValueError(f"{path}: only mono 16-bit PCM or 32-bit float WAVs can be mapped")
+    frames = size // dtype.itemsize
+    if not frames:
+        return np.zeros(0, dtype), sample_rate
+    return np.memmap(path, dtype=dtype, mode=mode, offset=offset, shape=(frames,)), sample_rate
+
+def _store(out, start, block):
+    """Write float samples into an int16 or float32 map"""
+    if out.dtype.kind == 'f':
+        out[start:start + len(block)] = block
+    else:
+        out[start:start + len(block)] = np.clip(block, -1.0, 1.0) * 32767
+
+def render_stems(recordings, paths, tempo_bpm=100, sample_rate=SAMPLE_RATE, dtype='float32'):
+    """Render each recording to its own memory-mapped WAV stem (one path per recording).
+
+    All stems get the same length, so they line up sample for sample when
+    mixed. Samples are scaled by MASTER_GAIN and not normalized. Returns the
+    frame count.
+    """
+    recordings = [as_recording(rec) for rec in recordings]
+    paths = list(paths)
+    if len(paths) != len(recordings):
+        raise ValueError(f"Need one stem path per recording (got {len(paths)} for {len(recordings)})")
+    seconds_per_beat = 60.0 / tempo_bpm
+    frames = max((_total_samples([rec], seconds_per_beat, sample_rate) for rec in recordings), default=0)
+    for rec, path in zip(recordings, paths):
+        out = create_wav_memmap(path, frames, sample_rate, dtype)
+        start = 0
+        for block in iter_blocks([rec], tempo_bpm, sample_rate):
+            _store(out, start, block)
+            start += len(block)
+        if isinstance(out, np.memmap):
+            out.flush()
+        stats = profiling.active.get()
+        if stats:
+            stats.count('bytes_written', out.nbytes)
+        del out
+    return frames
+
+def mix_stems(stem_paths, master_path, gains=None, dtype='float32'):
+    """Sum WAV stems into a new master WAV in place, a block at a time; returns the frame count.
+
+    Stems are opened read-only through memmaps and added straight into the
+    master's map, so nothing the size of the piece is held in memory. Stems
+    must share a sample rate; shorter ones are treated as silence at the end.
+    """
+    stems = [open_wav_memmap(path) for path in stem_paths]
+    gains = [1.0] * len(stems) if gains is None else list(gains)
+    if len(gains) != len(stems):
+        raise ValueError(f"Need one gain per stem (got {len(gains)} for {len(stems)})")
+    rates = {rate for _, rate in stems}
+    if len(rates) > 1:
+        raise ValueError(f"Stems have different sample rates: {sorted(rates)}")
+    sample_rate = rates.pop() if rates else SAMPLE_RATE
+    frames = max((len(samples) for samples, _ in stems), default=0)
+    master = create_wav_memmap(master_path, frames, sample_rate, dtype)
+    scratch = np.empty(min(frames, _MIX_BLOCK), dtype=np.float32)
+    for lo in range(0, frames, _MIX_BLOCK):
+        hi = min(lo + _MIX_BLOCK, frames)
+        acc = scratch[:hi - lo]
+        acc.fill(0.0)
+        for (samples, _), gain in zip(stems, gains):
+            part = samples[lo:hi]
+            if not len(part):
+                continue
+            scale = gain / 32767 if samples.dtype.kind == 'i' else gain
+            acc[:len(part)] += part * np.float32(scale)
+        _store(master, lo, acc)
+    if isinstance(master, np.memmap):
+        master.flush()
+    stats = profiling.active.get()
+    if stats:
+        stats.count('bytes_written', master.nbytes)
+    return frames